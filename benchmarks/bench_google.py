@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark oopygtd's Google traffic against a local fake server.
+
+Starts benchmarks/fake_google.py in process, fills it with task lists and
+events, and runs these commands against it through quickstart.py:
+
+    fetch_all (cold)  GTD.fetch_all() with an empty local mirror
+    fetch_all (warm)  GTD.fetch_all() again, syncing only changes
+    process_inbox     the changes process_inbox() makes for every Inbox item,
+                      sent through the operation queue
+    clear_g_list      clear_g_list() on the Maybe Someday list
+
+For each command it reports round trips (HTTP requests), API calls (counting
+each part of a batch), bytes sent and received, and wall time. Everything runs
+on a copy of the modules in a temporary directory, since they keep their data
+files next to their source, so your real data isn't touched.
+
+oopygtd.py is imported with the placeholder secrets.py from benchmarks/standins,
+since nothing here signs in to Firebase: the Firebase-only nodes fetch_all()
+imports are read from an empty local Firebase mirror (see fbmirror.py). If it
+still can't be imported, the fetch_all commands are reported as failed.
+"""
+
+import argparse
+import atexit
+import datetime
+import importlib
+import io
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+from contextlib import redirect_stdout
+from inspect import currentframe, getframeinfo
+from pathlib import Path
+from time import perf_counter
+
+FILENAME = getframeinfo(currentframe()).filename
+PARENT = Path(FILENAME).resolve().parent
+REPO = PARENT.parent
+RESULTS_FILE = PARENT / 'bench_google.json'
+STANDINS = PARENT / 'standins'
+
+sys.path.insert(0, str(PARENT))
+from fake_google import FakeGoogle  # noqa: E402
+
+# Modules copied into the temporary directory.
+MODULES = ['quickstart.py', 'mirror.py', 'opqueue.py', 'search.py',
+           'tasktree.py', 'model.py', 'oopygtd.py', 'fbmirror.py',
+           'timing.py']
+LISTS = {'inbox': 'Inbox', 'next_actions': 'Next Actions',
+         'projects': 'Projects', 'maybe_someday': 'Maybe Someday',
+         'waiting_for': 'Waiting For'}
+WORDS = ('call email buy fix write review plan book schedule clean pay read '
+         'ask send check update order return renew cancel draft print sign '
+         'garden taxes report meeting dentist plumber car insurance').split()
+
+
+def sentence(rng, n=5):
+    return ' '.join(rng.choice(WORDS) for _ in range(n)).capitalize()
+
+
+def fill(fake, tasks, events, seed=0):
+    """Create task lists with tasks (some of them subtasks) and events.
+
+    Tasks are dated a day back, so incremental syncs don't see them as new.
+    """
+    rng = random.Random(seed)
+    now = datetime.datetime.now(datetime.timezone.utc)
+    updated = (now - datetime.timedelta(days=1)).strftime(
+        '%Y-%m-%dT%H:%M:%S.%fZ')
+    for title in LISTS.values():
+        list = fake.add_list(title)
+        parents = []
+        for _ in range(tasks):
+            body = {'title': sentence(rng), 'updated': updated}
+            if parents and rng.random() < 0.2:
+                body['parent'] = rng.choice(parents)
+            parents.append(fake.add_task(list, body)['id'])
+    for _ in range(events):
+        start = now + datetime.timedelta(minutes=rng.randrange(30 * 24 * 60))
+        fake.add_event({
+            'summary': sentence(rng, 3),
+            'start': {'dateTime': start.isoformat()},
+            'end': {'dateTime': (start + datetime.timedelta(hours=1))
+                    .isoformat()},
+        })
+
+
+def measure(fake, results, command, func):
+    """Run func with output discarded and record its traffic."""
+    fake.reset_stats()
+    start = perf_counter()
+    try:
+        with redirect_stdout(io.StringIO()):
+            func()
+        error = None
+    except Exception as e:
+        error = '{}: {}'.format(type(e).__name__, e)
+    seconds = perf_counter() - start
+    result = dict(fake.stats, command=command, seconds=seconds, error=error)
+    results.append(result)
+    return result
+
+
+def process_inbox(opqueue, quickstart):
+    """Make the changes process_inbox() would for every Inbox item.
+
+    Items are sent to each list in turn (or completed, for 'do it now'), then
+    deleted from the Inbox, and the queue is flushed.
+    """
+    targets = ['next_actions', 'waiting_for', 'projects', 'maybe_someday',
+               None]
+    # Read the whole Inbox first, as oopygtd does, since the queue starts
+    # sending changes right away.
+    for n, task in enumerate(quickstart.fetch_g_tasks('inbox')):
+        target = targets[n % len(targets)]
+        if target is None:
+            opqueue.submit('complete', 'inbox', task=task['id'])
+        else:
+            opqueue.submit('insert', target, body={'title': task['title']})
+            opqueue.submit('delete', 'inbox', task=task['id'])
+    left = opqueue.flush()
+    if left:
+        # Ie because of injected errors; they're retried later.
+        print(f'process_inbox: {left} operations left in queue',
+              file=sys.stderr)
+
+
+def run(args):
+    fake = FakeGoogle(args.latency, args.page_size, args.error_rate)
+    url = fake.start()
+    fill(fake, args.tasks, args.events)
+    directory = tempfile.mkdtemp(prefix='bench_google.')
+    cwd = os.getcwd()
+    results = []
+    opqueue = None
+    try:
+        for module in MODULES:
+            shutil.copy(REPO / module, directory)
+        shutil.copy(STANDINS / 'secrets.py', directory)
+        os.environ['PYGTD_GOOGLE_API'] = url
+        os.environ['PYGTD_FB_MIRROR'] = '1'
+        sys.path.insert(0, directory)
+        # clear_g_list() writes a file to the working directory.
+        os.chdir(directory)
+        quickstart = importlib.import_module('quickstart')
+        opqueue = importlib.import_module('opqueue')
+        importlib.import_module('fbmirror').FirebaseMirror().mark('alive')
+
+        # Imported by measure(), so a failure is reported like any other.
+        measure(fake, results, 'fetch_all (cold)',
+                lambda: importlib.import_module('oopygtd').GTD().fetch_all())
+        measure(fake, results, 'fetch_all (warm)',
+                lambda: importlib.import_module('oopygtd').GTD().fetch_all())
+        measure(fake, results, 'process_inbox',
+                lambda: process_inbox(opqueue, quickstart))
+        measure(fake, results, 'clear_g_list',
+                lambda: quickstart.clear_g_list('maybe_someday'))
+    finally:
+        if opqueue:
+            # Its queue file is about to be deleted.
+            atexit.unregister(opqueue.flush)
+        os.chdir(cwd)
+        fake.stop()
+        shutil.rmtree(directory)
+    return results
+
+
+def print_table(results):
+    print('{:18} {:>8} {:>8} {:>12} {:>12} {:>9}'.format(
+        'command', 'trips', 'calls', 'bytes sent', 'bytes recv', 'seconds'))
+    for r in results:
+        print('{:18} {:>8} {:>8} {:>12} {:>12} {:>9.3f}'.format(
+            r['command'], r['requests'], r['calls'], r['bytes_in'],
+            r['bytes_out'], r['seconds']))
+        if r['error']:
+            print('    failed:', r['error'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--tasks', type=int, default=200,
+                        help='Tasks in each list.')
+    parser.add_argument('--events', type=int, default=200,
+                        help='Calendar events in the next 30 days.')
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help='Seconds added to each round trip.')
+    parser.add_argument('--page-size', type=int,
+                        help='Max items per page the server returns.')
+    parser.add_argument('--error-rate', type=float, default=0,
+                        help='Fraction of API calls that fail.')
+    parser.add_argument('--output', default=str(RESULTS_FILE),
+                        help='JSON file to write results to.')
+    args = parser.parse_args()
+
+    results = run(args)
+    with open(args.output, 'w') as f:
+        json.dump({'date': datetime.datetime.now().isoformat(),
+                   'settings': vars(args), 'results': results}, f, indent=2)
+    print_table(results)
+    print(f'\nResults written to {args.output}')
+    return 1 if any(r['error'] for r in results) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+
+"""
+Check how long it takes to import oopygtd and quickstart.
+
+Quick commands like oopygtd.py -i pay for everything imported at start-up, so
+the Google and Firebase client libraries, dateutil, the clipboard and menu
+modules, and the logins that go with them are only loaded when a command needs
+them. This imports each module in a fresh interpreter a few times and fails
+(exit status 1) if the median import takes longer than the budget, or if any
+of those heavy modules were loaded:
+
+    bench_import.py --budget 100
+
+Without a secrets.py (Firebase settings) next to oopygtd.py, the placeholder in
+benchmarks/standins is used, so the check runs in a clean checkout. A module
+that can't be imported at all counts as a failure.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+from inspect import currentframe, getframeinfo
+from pathlib import Path
+
+FILENAME = getframeinfo(currentframe()).filename
+PARENT = Path(FILENAME).resolve().parent
+REPO = PARENT.parent
+# Found after the repo's own modules, so a real secrets.py takes precedence.
+STANDINS = PARENT / 'standins'
+
+MODULES = ['quickstart', 'oopygtd']
+# Milliseconds a module may take to import.
+BUDGET_MS = 100
+REPEAT = 5
+# Modules that shouldn't be loaded until a command uses them.
+HEAVY = ['googleapiclient', 'oauth2client', 'httplib2', 'pyrebase',
+         'cursesmenu', 'dateutil', 'pyperclip', 'concurrent.futures']
+
+# Run in a fresh interpreter; prints import time and heavy modules loaded.
+PROBE = '''
+import json, sys, time
+start = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - start
+print(json.dumps({{'ms': seconds * 1000,
+                  'heavy': [m for m in {heavy!r} if m in sys.modules]}}))
+'''
+
+
+def probe(module):
+    """Import module in a fresh interpreter. Return result dict or None."""
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(
+        filter(None, [str(STANDINS), os.environ.get('PYTHONPATH')])))
+    out = subprocess.run(
+        [sys.executable, '-c', PROBE.format(module=module, heavy=HEAVY)],
+        cwd=REPO, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        text=True)
+    if out.returncode:
+        error = out.stderr.strip().splitlines()
+        print('Could not import {}: {}'.format(
+            module, error[-1] if error else '?'), file=sys.stderr)
+        return None
+    return json.loads(out.stdout.splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--budget', type=float, default=BUDGET_MS,
+                        help='Milliseconds each import may take.')
+    parser.add_argument('--repeat', type=int, default=REPEAT,
+                        help='Imports per module; the median is used.')
+    parser.add_argument('modules', nargs='*', default=MODULES,
+                        help='Modules to import.')
+    args = parser.parse_args()
+
+    ok = True
+    print('{:12} {:>9} {:>9}  {}'.format('module', 'median ms', 'budget',
+                                        'heavy modules loaded'))
+    for module in args.modules:
+        results = [probe(module)]
+        if results[0] is None:
+            ok = False
+            print('{:12} {:>9} {:>9.0f}  {}'.format(
+                module, '-', args.budget, 'IMPORT FAILED'))
+            continue
+        results.extend(probe(module) for _ in range(args.repeat - 1))
+        median = statistics.median(r['ms'] for r in results)
+        heavy = sorted(set().union(*(r['heavy'] for r in results)))
+        over = median > args.budget or heavy
+        ok = ok and not over
+        print('{:12} {:>9.1f} {:>9.0f}  {}{}'.format(
+            module, median, args.budget, ', '.join(heavy) or '-',
+            '  OVER BUDGET' if over else ''))
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
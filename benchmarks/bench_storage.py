@@ -0,0 +1,289 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark pygtd storage and processing on synthetic data.
+
+For each storage backend and dataset size, a GTD dataset is generated (as an
+old-style pygtd.json) and these operations are timed:
+
+    migrate        first load_data(), converting pygtd.json
+    load           load_data() and read every container
+    add_to_inbox   add one item, repeated
+    capture        quick_add.py-style capture of one item, repeated
+    list_projects  print projects with their next actions
+    complete       complete one next action, repeated
+    file_to_inbox  import a text file with one line per item
+    save           save_data() (compaction)
+
+Each (backend, size) runs in its own subprocess, on a copy of the pygtd modules
+in a temporary directory (pygtd keeps its data files next to its source), so
+peak RSS is per dataset and nothing touches your real data. Results are
+printed as a table and written as JSON, ie to compare two versions:
+
+    bench_storage.py --output before.json
+    (make changes)
+    bench_storage.py --output after.json --compare before.json
+"""
+
+import argparse
+import datetime
+import io
+import json
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+from contextlib import redirect_stdout
+from inspect import currentframe, getframeinfo
+from pathlib import Path
+from time import perf_counter
+
+FILENAME = getframeinfo(currentframe()).filename
+PARENT = Path(FILENAME).resolve().parent
+REPO = PARENT.parent
+RESULTS_FILE = PARENT / 'bench_storage.json'
+
+SIZES = [1000, 10000, 100000, 1000000]
+STORAGES = ['journal', 'sqlite']
+# Modules copied into each run's temporary directory.
+MODULES = ['pygtd.py', 'capture.py', 'journal.py', 'search.py',
+           'sqlite_store.py', 'timing.py']
+# Number of times single-item operations are repeated.
+REPEAT = 200
+
+# Share of dataset in each container.
+SHARES = {
+    'inbox': 0.1,
+    'actions': 0.3,
+    'projects': 0.05,
+    'someday_maybe': 0.1,
+    'waiting_for': 0.05,
+    'scheduled': 0.05,
+    'reference': 0.05,
+    'completed': 0.3,
+}
+WORDS = ('call email buy fix write review plan book schedule clean pay read '
+         'ask send check update order return renew cancel draft print sign '
+         'garden taxes report meeting dentist plumber car insurance budget '
+         'invoice passport groceries birthday laptop backup website').split()
+
+
+def sentence(rng, n=6):
+    return ' '.join(rng.choice(WORDS) for _ in range(n))
+
+
+def dataset(size, seed=0):
+    """Return synthetic pygtd data with about size items in all."""
+    rng = random.Random(seed)
+    key = iter(range(1500000000, 1500000000 + 2 * size))
+    data = {}
+    for container, share in SHARES.items():
+        data[container] = {str(next(key)): None
+                           for _ in range(max(1, int(size * share)))}
+    for container in ('inbox', 'actions', 'someday_maybe', 'waiting_for',
+                      'reference'):
+        for k in data[container]:
+            data[container][k] = sentence(rng)
+    for k in data['scheduled']:
+        data['scheduled'][k] = {'date': '2030-01-01 09:00:00',
+                                'text': sentence(rng)}
+    for k in data['completed']:
+        data['completed'][k] = {'completion_date': 'Monday, 01. January 2018',
+                                'text': sentence(rng)}
+    # Each project points at one of the first actions.
+    for k, action in zip(data['projects'], data['actions']):
+        data['projects'][k] = {'short_name': rng.choice(WORDS),
+                               'text': sentence(rng, 10),
+                               'next_actions': [action]}
+    return data
+
+
+def written():
+    """Return bytes this process has passed to write calls, if known."""
+    try:
+        with open('/proc/self/io', 'r') as f:
+            for line in f:
+                if line.startswith('wchar:'):
+                    return int(line.split()[1])
+    except OSError:
+        return None
+
+
+def peak_rss():
+    """Return peak resident set size of this process in KiB."""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS reports bytes, Linux KiB.
+    return rss // 1024 if sys.platform == 'darwin' else rss
+
+
+def measure(results, op, count, func):
+    """Run func with output discarded and record timing for count ops."""
+    before = written()
+    start = perf_counter()
+    with redirect_stdout(io.StringIO()):
+        func()
+    seconds = perf_counter() - start
+    after = written()
+    bytes_written = None if before is None else after - before
+    results.append({
+        'op': op,
+        'count': count,
+        'seconds': seconds,
+        'ops_per_sec': count / seconds if seconds else None,
+        'bytes_written': bytes_written,
+        'bytes_per_op': (None if bytes_written is None or not count
+                         else bytes_written / count),
+        'peak_rss_kb': peak_rss(),
+    })
+
+
+def run(size, directory):
+    """Benchmark one dataset size in directory. Return list of results."""
+    sys.path.insert(0, directory)
+    import capture
+    import pygtd
+
+    data = dataset(size)
+    with open(pygtd.DATA_FILE, 'w') as f:
+        json.dump(data, f)
+    total = sum(len(items) for items in data.values())
+    projects = data['projects']
+    # Actions no project points at.
+    completable = list(data['actions'])[len(projects):][-REPEAT:]
+    lines = Path(directory) / 'import.txt'
+    with open(lines, 'w') as f:
+        rng = random.Random(1)
+        for _ in range(size):
+            f.write(sentence(rng) + '\n')
+    del data
+
+    def load():
+        pygtd.load_data()
+        for container in SHARES:
+            len(pygtd.data[container])
+
+    def add_to_inbox():
+        for n in range(REPEAT):
+            pygtd.add_to_inbox('benchmark item {}'.format(n))
+
+    def capture_items():
+        spool = os.path.join(directory, 'bench.capture')
+        for n in range(REPEAT):
+            capture.capture('benchmark item {}'.format(n), spool)
+
+    def complete():
+        for key in completable:
+            pygtd.complete(key, 'actions')
+
+    results = []
+    measure(results, 'migrate', total, pygtd.load_data)
+    measure(results, 'load', total, load)
+    measure(results, 'add_to_inbox', REPEAT, add_to_inbox)
+    measure(results, 'capture', REPEAT, capture_items)
+    measure(results, 'list_projects',
+            len(projects) + sum(len(p['next_actions'])
+                                for p in projects.values()),
+            pygtd.list_projects)
+    measure(results, 'complete', len(completable), complete)
+    measure(results, 'file_to_inbox', size,
+            lambda: pygtd.file_to_inbox(str(lines)))
+    measure(results, 'save', sum(len(items) for items in pygtd.data.values()),
+            pygtd.save_data)
+    return results
+
+
+def run_subprocess(storage, size):
+    """Run benchmark for one backend and size in a fresh process."""
+    directory = tempfile.mkdtemp(prefix='bench_storage.')
+    try:
+        for module in MODULES:
+            shutil.copy(REPO / module, directory)
+        env = dict(os.environ, PYGTD_STORAGE=storage)
+        out = subprocess.run(
+            [sys.executable, FILENAME, '--worker', str(size), directory],
+            env=env, check=True, stdout=subprocess.PIPE, text=True).stdout
+        results = json.loads(out.splitlines()[-1])
+    finally:
+        shutil.rmtree(directory)
+    for result in results:
+        result.update(storage=storage, size=size)
+    return results
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                              cwd=REPO, stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_table(results, baseline=None):
+    """Print results, with change in ops/s against baseline results."""
+    old = {(r['storage'], r['size'], r['op']): r for r in baseline or []}
+    print('{:8} {:>8} {:14} {:>12} {:>10} {:>12} {:>10}{}'.format(
+        'storage', 'size', 'op', 'ops/s', 'seconds', 'bytes/op', 'peak MiB',
+        ' vs baseline' if baseline else ''))
+    for r in results:
+        change = ''
+        before = old.get((r['storage'], r['size'], r['op']))
+        if before and before['ops_per_sec'] and r['ops_per_sec']:
+            change = ' {:+11.0%}'.format(
+                r['ops_per_sec'] / before['ops_per_sec'] - 1)
+        print('{:8} {:>8} {:14} {:>12.0f} {:>10.3f} {:>12} {:>10.1f}{}'.format(
+            r['storage'], r['size'], r['op'], r['ops_per_sec'] or 0,
+            r['seconds'],
+            '-' if r['bytes_per_op'] is None else round(r['bytes_per_op']),
+            r['peak_rss_kb'] / 1024, change))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sizes', nargs='+', type=int, default=SIZES,
+                        metavar='N', help='Dataset sizes (number of items).')
+    parser.add_argument('--storage', nargs='+', choices=STORAGES,
+                        default=STORAGES, help='Storage backends to test.')
+    parser.add_argument('--output', default=str(RESULTS_FILE),
+                        help='JSON file to write results to.')
+    parser.add_argument('--compare', metavar='FILE',
+                        help='Earlier results to compare against.')
+    parser.add_argument('--worker', nargs=2, metavar=('SIZE', 'DIR'),
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        size, directory = args.worker
+        results = run(int(size), directory)
+        print(json.dumps(results))
+        return
+
+    results = []
+    for size in args.sizes:
+        for storage in args.storage:
+            print(f'Running {storage} with {size} items...', file=sys.stderr)
+            results.extend(run_subprocess(storage, size))
+    report = {
+        'date': datetime.datetime.now().isoformat(),
+        'revision': git_revision(),
+        'python': sys.version.split()[0],
+        'repeat': REPEAT,
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)['results']
+    print_table(results, baseline)
+    print(f'\nResults written to {args.output}')
+
+
+if __name__ == '__main__':
+    main()
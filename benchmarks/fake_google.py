@@ -0,0 +1,398 @@
+#!/usr/bin/env python3
+
+"""
+Local stand-in for the Google Tasks v1 and Calendar v3 APIs.
+
+Serves just enough of both for quickstart.py: discovery documents, task lists,
+tasks (list, get, insert, update, patch, delete), events (list, insert) and
+HTTP batch requests. Data is kept in memory. Latency, page size and error rate
+can be set, and every request is counted.
+
+Point quickstart.py at it by setting PYGTD_GOOGLE_API to its URL:
+
+    fake_google.py --port 8099 --latency 0.05 &
+    PYGTD_GOOGLE_API=http://127.0.0.1:8099 oopygtd.py --refresh -o
+
+GET /_stats returns the counters as JSON and POST /_reset clears them.
+"""
+
+import argparse
+import datetime
+import email.parser
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, unquote, urlsplit
+
+REASONS = {200: 'OK', 204: 'No Content', 400: 'Bad Request',
+           404: 'Not Found', 410: 'Gone', 500: 'Internal Server Error',
+           503: 'Service Unavailable'}
+
+
+def now():
+    """Return current time as RFC 3339 UTC string, as Google gives it."""
+    return datetime.datetime.now(datetime.timezone.utc).strftime(
+        '%Y-%m-%dT%H:%M:%S.%fZ')
+
+
+def parse_time(value):
+    """Return RFC 3339 date or date-time string as aware datetime."""
+    when = datetime.datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=datetime.timezone.utc)
+    return when
+
+
+def event_start(event):
+    start = event['start']
+    return parse_time(start.get('dateTime') or start['date'])
+
+
+def flag(params, name, default):
+    """Return boolean query parameter."""
+    if name not in params:
+        return default
+    return params[name] == 'true'
+
+
+def discovery_document(api, version, url):
+    """Return bundled discovery document for API, pointed at url."""
+    import googleapiclient
+    path = (Path(googleapiclient.__file__).parent / 'discovery_cache'
+            / 'documents' / f'{api}.{version}.json')
+    doc = json.loads(path.read_text())
+    doc['rootUrl'] = doc['mtlsRootUrl'] = url + '/'
+    doc['baseUrl'] = url + '/' + doc['servicePath']
+    return doc
+
+
+class FakeGoogle():
+    """In-memory Tasks and Calendar data, with request counters.
+
+    latency is added to each HTTP round trip, page_size caps the number of
+    items per page whatever the client asks for, and error_rate is the
+    fraction of API calls (including each part of a batch) that fail with
+    error_status.
+
+    """
+
+    def __init__(self, latency=0, page_size=None, error_rate=0,
+                 error_status=503, seed=0):
+        self.latency = latency
+        self.page_size = page_size
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.lists = {}
+        self.events = {}
+        # Change number of each event, and of the latest change, for sync
+        # tokens.
+        self.changes = {}
+        self.sequence = 0
+        self.server = None
+        self.url = None
+        self.reset_stats()
+
+    # Data
+
+    def add_list(self, title):
+        """Create task list. Return its ID."""
+        id = 'list-' + uuid.uuid4().hex[:12]
+        self.lists[id] = {'id': id, 'title': title, 'tasks': {}}
+        return id
+
+    def add_task(self, list, body):
+        """Create task in list from body. Return it."""
+        tasks = self.lists[list]['tasks']
+        id = uuid.uuid4().hex[:16]
+        task = {
+            'kind': 'tasks#task',
+            'id': id,
+            'etag': '"{}"'.format(uuid.uuid4().hex),
+            'title': '',
+            'updated': now(),
+            'selfLink': f'{self.url}/tasks/v1/lists/{list}/tasks/{id}',
+            'position': '{:020d}'.format(len(tasks)),
+            'status': 'needsAction',
+        }
+        task.update(body)
+        task['id'] = id
+        tasks[id] = task
+        return task
+
+    def add_event(self, body):
+        """Create event from body. Return it."""
+        self.sequence += 1
+        id = uuid.uuid4().hex
+        event = {
+            'kind': 'calendar#event',
+            'id': id,
+            'etag': '"{}"'.format(uuid.uuid4().hex),
+            'status': 'confirmed',
+            'htmlLink': f'{self.url}/calendar/event?eid={id}',
+            'created': now(),
+            'updated': now(),
+        }
+        event.update(body)
+        event['id'] = id
+        self.events[id] = event
+        self.changes[id] = self.sequence
+        return event
+
+    # Counters
+
+    def reset_stats(self):
+        self.stats = Counter(requests=0, calls=0, bytes_in=0, bytes_out=0,
+                             errors=0)
+
+    def count(self, **counts):
+        with self.lock:
+            self.stats.update(counts)
+
+    # API
+
+    def page(self, items, params, default, limit):
+        """Return (page of items, next page token or None)."""
+        size = min(int(params.get('maxResults', default)), limit)
+        if self.page_size:
+            size = min(size, self.page_size)
+        offset = int(params.get('pageToken', 0))
+        end = offset + size
+        return items[offset:end], (str(end) if end < len(items) else None)
+
+    def list_tasklists(self, method, params, body):
+        items = [{'kind': 'tasks#taskList', 'id': l['id'],
+                  'title': l['title'], 'updated': now()}
+                 for l in self.lists.values()]
+        return 200, {'kind': 'tasks#taskLists', 'items': items}
+
+    def list_tasks(self, method, params, body, list):
+        show_completed = flag(params, 'showCompleted', True)
+        show_deleted = flag(params, 'showDeleted', False)
+        updated_min = params.get('updatedMin')
+        items = []
+        for task in self.lists[list]['tasks'].values():
+            if task.get('deleted') and not show_deleted:
+                continue
+            if task.get('status') == 'completed' and not show_completed:
+                continue
+            if updated_min and parse_time(task['updated']) < parse_time(
+                    updated_min):
+                continue
+            items.append(task)
+        items.sort(key=lambda task: task['position'])
+        items, token = self.page(items, params, 20, 100)
+        response = {'kind': 'tasks#tasks', 'items': items}
+        if token:
+            response['nextPageToken'] = token
+        return 200, response
+
+    def task(self, method, params, body, list, id):
+        task = self.lists[list]['tasks'].get(id)
+        if task is None or (task.get('deleted') and method != 'GET'):
+            return 404, {'error': {'code': 404, 'message': 'Not Found'}}
+        if method == 'DELETE':
+            task.update(deleted=True, updated=now())
+            return 204, None
+        if method in ('PUT', 'PATCH'):
+            if method == 'PUT':
+                keep = {k: task[k] for k in ('kind', 'id', 'selfLink',
+                                             'position')}
+                task.clear()
+                task.update(keep)
+            task.update(body)
+            task['updated'] = now()
+            if task.get('status') == 'completed':
+                task.setdefault('completed', now())
+        return 200, task
+
+    def list_events(self, method, params, body, calendar):
+        if 'syncToken' in params:
+            since = int(params['syncToken'])
+            items = [self.events[id] for id, change in self.changes.items()
+                     if change > since]
+        else:
+            time_min = params.get('timeMin')
+            time_max = params.get('timeMax')
+            items = [e for e in self.events.values()
+                     if e['status'] != 'cancelled'
+                     and (not time_min
+                          or event_start(e) >= parse_time(time_min))
+                     and (not time_max
+                          or event_start(e) < parse_time(time_max))]
+        items.sort(key=event_start)
+        items, token = self.page(items, params, 250, 2500)
+        response = {'kind': 'calendar#events', 'items': items}
+        if token:
+            response['nextPageToken'] = token
+        else:
+            response['nextSyncToken'] = str(self.sequence)
+        return 200, response
+
+    ROUTES = [
+        ('GET', r'/tasks/v1/users/@me/lists', 'list_tasklists'),
+        ('GET', r'/tasks/v1/lists/([^/]+)/tasks', 'list_tasks'),
+        ('POST', r'/tasks/v1/lists/([^/]+)/tasks', 'insert_task'),
+        ('GET|PUT|PATCH|DELETE', r'/tasks/v1/lists/([^/]+)/tasks/([^/]+)',
+         'task'),
+        ('GET', r'/calendar/v3/calendars/([^/]+)/events', 'list_events'),
+        ('POST', r'/calendar/v3/calendars/([^/]+)/events', 'insert_event'),
+    ]
+
+    def insert_task(self, method, params, body, list):
+        return 200, self.add_task(list, body)
+
+    def insert_event(self, method, params, body, calendar):
+        return 200, self.add_event(body)
+
+    def call(self, method, target, body):
+        """Handle one API call. Return (status, response dict or None)."""
+        url = urlsplit(target)
+        path = unquote(url.path)
+        params = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        for methods, pattern, name in self.ROUTES:
+            match = re.fullmatch(pattern, path)
+            if match and method in methods.split('|'):
+                break
+        else:
+            return 404, {'error': {'code': 404, 'message': 'Not Found'}}
+        self.count(calls=1)
+        if self.error_rate and self.random.random() < self.error_rate:
+            self.count(errors=1)
+            return self.error_status, {'error': {
+                'code': self.error_status, 'message': 'Injected error'}}
+        with self.lock:
+            try:
+                return getattr(self, name)(method, params, body,
+                                           *match.groups())
+            except KeyError:
+                return 404, {'error': {'code': 404, 'message': 'Not Found'}}
+
+    def batch(self, content_type, body):
+        """Handle multipart/mixed batch. Return (content type, body)."""
+        message = email.parser.BytesParser().parsebytes(
+            b'Content-Type: ' + content_type.encode() + b'\r\n\r\n' + body)
+        boundary = 'batch_' + uuid.uuid4().hex
+        parts = []
+        for part in message.get_payload():
+            request = part.get_payload()
+            head, _, data = request.partition('\r\n\r\n')
+            if not _:
+                head, _, data = request.partition('\n\n')
+            method, target, _ = head.splitlines()[0].split(' ', 2)
+            status, response = self.call(
+                method, target, json.loads(data) if data.strip() else None)
+            content = json.dumps(response) if response is not None else ''
+            parts.append(
+                f'--{boundary}\r\n'
+                'Content-Type: application/http\r\n'
+                f"Content-ID: <response-{part['Content-ID'].strip('<>')}>"
+                '\r\n\r\n'
+                f'HTTP/1.1 {status} {REASONS.get(status, "")}\r\n'
+                'Content-Type: application/json; charset=UTF-8\r\n'
+                f'Content-Length: {len(content.encode())}\r\n\r\n'
+                f'{content}\r\n')
+        parts.append(f'--{boundary}--\r\n')
+        return (f'multipart/mixed; boundary={boundary}',
+                ''.join(parts).encode())
+
+    # Server
+
+    def start(self, port=0):
+        """Serve in a background thread. Return base URL."""
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self.server.daemon_threads = True
+        self.server.fake = self
+        self.url = 'http://127.0.0.1:{}'.format(self.server.server_port)
+        threading.Thread(target=self.server.serve_forever,
+                         daemon=True).start()
+        return self.url
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class Handler(BaseHTTPRequestHandler):
+    """Passes HTTP requests to the FakeGoogle instance of the server."""
+
+    protocol_version = 'HTTP/1.1'  # keep-alive, like Google
+
+    def log_message(self, format, *args):
+        pass
+
+    def handle_request(self):
+        fake = self.server.fake
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length)
+        fake.count(requests=1, bytes_in=len(self.requestline) + 2
+                   + len(str(self.headers)) + length)
+        if fake.latency:
+            time.sleep(fake.latency)
+
+        path = urlsplit(self.path).path
+        content_type = 'application/json; charset=UTF-8'
+        match = re.fullmatch(r'/discovery/v1/apis/(\w+)/(\w+)/rest', path)
+        if match:
+            status = 200
+            content = json.dumps(discovery_document(*match.groups(),
+                                                    fake.url)).encode()
+        elif path.startswith('/batch'):
+            status = 200
+            content_type, content = fake.batch(
+                self.headers['Content-Type'], body)
+        elif path == '/_stats':
+            status, content = 200, json.dumps(fake.stats).encode()
+        elif path == '/_reset':
+            fake.reset_stats()
+            status, content = 204, b''
+        else:
+            status, response = fake.call(
+                self.command, self.path, json.loads(body) if body else None)
+            content = json.dumps(response).encode() if response else b''
+
+        head = (f'HTTP/1.1 {status} {REASONS.get(status, "")}\r\n'
+                f'Content-Type: {content_type}\r\n'
+                f'Content-Length: {len(content)}\r\n\r\n').encode()
+        self.wfile.write(head + content)
+        fake.count(bytes_out=len(head) + len(content))
+
+    do_GET = do_POST = do_PUT = do_PATCH = do_DELETE = handle_request
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--port', type=int, default=8099)
+    parser.add_argument('--latency', type=float, default=0,
+                        help='Seconds added to each round trip.')
+    parser.add_argument('--page-size', type=int,
+                        help='Max items per page, whatever is asked for.')
+    parser.add_argument('--error-rate', type=float, default=0,
+                        help='Fraction of API calls that fail.')
+    parser.add_argument('--error-status', type=int, default=503)
+    parser.add_argument('--lists', nargs='+',
+                        default=['Inbox', 'Next Actions', 'Projects',
+                                 'Maybe Someday', 'Waiting For'],
+                        help='Task lists to create.')
+    args = parser.parse_args()
+
+    fake = FakeGoogle(args.latency, args.page_size, args.error_rate,
+                      args.error_status)
+    for title in args.lists:
+        fake.add_list(title)
+    print('Serving fake Google APIs at', fake.start(args.port))
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        fake.stop()
+
+
+if __name__ == '__main__':
+    main()
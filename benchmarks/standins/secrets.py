@@ -0,0 +1,9 @@
+"""
+Placeholder Firebase settings, so oopygtd can be imported by the benchmarks
+without a real secrets.py. Nothing here is valid; the benchmarks never sign in
+to Firebase.
+"""
+
+apiKey = 'benchmark-placeholder'
+email = 'benchmark@example.com'
+password = 'benchmark-placeholder'
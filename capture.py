@@ -0,0 +1,53 @@
+"""
+Minimal Inbox capture for use with a global keyboard shortcut.
+
+Captured text is appended to a small spool file without reading the main data
+store, and only modules needed to write one line are imported. pygtd merges
+the spool into the Inbox the next time it loads its data.
+"""
+
+import fcntl
+import json
+import os
+from time import time
+
+CAPTURE_FILE = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                            'pygtd.capture')
+
+
+def capture(text, path=CAPTURE_FILE):
+    """Durably append text to spool file as a new Inbox item."""
+    line = json.dumps({'k': str(time()), 'v': text}) + '\n'
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        # Lock so a merge in progress can't truncate away this item.
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        os.write(fd, line.encode())
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def drain(merge, path=CAPTURE_FILE):
+    """Pass captured (key, text) pairs to merge, then empty spool file.
+
+    Return number of items merged. If merge raises, the spool is left as is
+    and the same items are offered again next time.
+    """
+    try:
+        f = open(path, 'r+')
+    except FileNotFoundError:
+        return 0
+    with f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        items = []
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            items.append((record['k'], record['v']))
+        if items:
+            merge(items)
+        f.truncate(0)
+    return len(items)
@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+
+"""
+Local on-disk mirror of the GTD nodes in Firebase.
+
+Run this module to open a pyrebase stream on each node and apply the put and
+patch events to fb_mirror.json as they arrive. With PYGTD_FB_MIRROR set,
+GTD.fb_import() then reads from that file instead of Firebase, so changes made
+on another device show up without waiting on the network.
+
+Firebase stops sending events once the ID token the streams were opened with
+expires (after an hour), so the token is refreshed and the streams reopened
+before then, and whenever Firebase revokes it or a stream dies. While streams
+are up the mirror records when it was last known to be live; readers should
+check current() and go to Firebase if it isn't.
+
+Events can also be fed in from any other source, ie a file of recorded events
+(one JSON object per line with node, event, path and data keys):
+
+    fbmirror.py --replay events.jsonl
+"""
+
+import argparse
+import json
+import os
+import threading
+from inspect import currentframe, getframeinfo
+from pathlib import Path
+from time import time
+
+FILENAME = getframeinfo(currentframe()).filename
+PARENT = Path(FILENAME).resolve().parent
+FB_MIRROR_FILE = PARENT / 'fb_mirror.json'
+
+# Seconds to wait after an event before writing the mirror to disk, so a
+# burst of events is saved once.
+SAVE_DELAY = 1.0
+# Seconds between checks that the streams are still up. Each check that finds
+# them up is recorded in the mirror.
+CHECK_INTERVAL = 60
+# Seconds after which the mirror counts as out of date if no check has found
+# the streams up.
+STALE_AFTER = 5 * 60
+# Seconds after which streams are reopened with a refreshed ID token. (Tokens
+# expire after an hour.)
+TOKEN_REFRESH = 50 * 60
+# Key status is saved under in the mirror file. Firebase keys can't contain
+# '.', so it can't clash with a node.
+STATUS_KEY = '.status'
+
+
+class FirebaseMirror():
+    """Firebase data kept in a local JSON file, patched by stream events."""
+
+    def __init__(self, path=FB_MIRROR_FILE):
+        self.path = Path(path)
+        self.lock = threading.Lock()
+        self.timer = None
+        # Set when Firebase ends the streams, ie because the token expired.
+        self.disconnected = threading.Event()
+        try:
+            with open(self.path, 'r') as f:
+                self.data = json.load(f)
+        except (FileNotFoundError, ValueError):
+            self.data = {}
+        # Times the streams were last opened ('connected') and found up
+        # ('alive'), and of the last change ('event').
+        self.status = self.data.pop(STATUS_KEY, {})
+
+    def current(self, max_age=STALE_AFTER):
+        """Return True if the streams were up within the last max_age s."""
+        return time() - self.status.get('alive', 0) <= max_age
+
+    def mark(self, *keys):
+        """Set status times with given keys to now and save."""
+        with self.lock:
+            for key in keys:
+                self.status[key] = time()
+        self.save()
+
+    def node(self, name):
+        """Return contents of node, or None if it's empty."""
+        return self.data.get(name)
+
+    def set(self, keys, value):
+        """Set value at path given as list of keys. None deletes it."""
+        parent = self.data
+        for key in keys[:-1]:
+            child = parent.get(key)
+            if not isinstance(child, dict):
+                if value is None:
+                    return
+                child = parent[key] = {}
+            parent = child
+        if value is None:
+            parent.pop(keys[-1], None)
+        else:
+            parent[keys[-1]] = value
+
+    def apply(self, node, message):
+        """Apply one stream message for node. Return True if data changed.
+
+        put replaces the data at path; patch updates several children of path
+        at once. auth_revoked and cancel mean Firebase has stopped sending
+        events, so the streams need reopening. Other events (keep-alive, etc)
+        are ignored.
+        """
+        event = message.get('event')
+        if event in ('auth_revoked', 'cancel'):
+            self.disconnected.set()
+            return False
+        if event not in ('put', 'patch'):
+            return False
+        keys = [node] + [k for k in message['path'].split('/') if k]
+        with self.lock:
+            if event == 'put':
+                self.set(keys, message['data'])
+            else:
+                for subpath, value in message['data'].items():
+                    self.set(keys + [k for k in subpath.split('/') if k],
+                             value)
+            self.status['event'] = time()
+        return True
+
+    def save(self):
+        """Write mirror to disk atomically."""
+        with self.lock:
+            self.timer = None
+            tmp = self.path.with_suffix('.tmp')
+            with open(tmp, 'w') as f:
+                json.dump(dict(self.data, **{STATUS_KEY: self.status}), f)
+            os.replace(tmp, self.path)
+
+    def handle(self, node, message):
+        """Apply message and schedule a save. For use as stream handler."""
+        if self.apply(node, message):
+            with self.lock:
+                if self.timer is None:
+                    self.timer = threading.Timer(SAVE_DELAY, self.save)
+                    self.timer.start()
+
+    def feed(self, messages):
+        """Apply (node, message) pairs from any event source, then save.
+
+        The mirror counts as current afterwards, as the source is taken to be
+        up to date.
+        """
+        for node, message in messages:
+            self.apply(node, message)
+        self.mark('alive')
+
+    def listen(self, db, nodes, token):
+        """Open a pyrebase stream on each node. Return the streams.
+
+        Each stream starts with a put of the whole node, so the mirror is
+        brought up to date with anything missed while it wasn't listening.
+        """
+        self.disconnected.clear()
+        streams = [db.child(node).stream(
+            lambda message, node=node: self.handle(node, message), token)
+            for node in nodes]
+        self.mark('connected', 'alive')
+        return streams
+
+    def watch(self, streams, opened):
+        """Wait until streams need reopening, noting while they're up.
+
+        That's when Firebase ends them, one of their threads dies (pyrebase's
+        can, on messages it doesn't expect such as auth_revoked) or the token
+        is about to expire.
+        """
+        while not self.disconnected.wait(CHECK_INTERVAL):
+            if time() - opened > TOKEN_REFRESH:
+                return
+            threads = [getattr(stream, 'thread', None) for stream in streams]
+            if not all(thread is None or thread.is_alive()
+                       for thread in threads):
+                return
+            self.mark('alive')
+
+    def run(self, nodes):
+        """Mirror nodes until interrupted, reconnecting as needed."""
+        import oopygtd
+        db, user = oopygtd.get_firebase()
+        while True:
+            streams = self.listen(db, nodes, user['idToken'])
+            try:
+                self.watch(streams, time())
+            finally:
+                for stream in streams:
+                    stream.close()
+            # Retry until Firebase can be reached again.
+            while True:
+                try:
+                    db, user = oopygtd.refresh_firebase()
+                    break
+                except Exception as e:
+                    print(f'Could not refresh Firebase token ({e}); '
+                          'retrying.')
+                    self.disconnected.clear()
+                    self.disconnected.wait(CHECK_INTERVAL)
+
+
+def recorded_events(path):
+    """Yield (node, message) pairs from a JSON lines file of events."""
+    with open(path, 'r') as f:
+        for line in f:
+            if line.strip():
+                event = json.loads(line)
+                yield event.pop('node'), event
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--replay', metavar='FILE',
+                        help='Apply recorded events from FILE and exit.')
+    args = parser.parse_args()
+
+    fb_mirror = FirebaseMirror()
+    if args.replay:
+        fb_mirror.feed(recorded_events(args.replay))
+        return
+
+    import oopygtd
+    nodes = oopygtd.FB_NODES + ['calendar']
+    print('Mirroring {} to {}. Ctrl-C to stop.'.format(
+        ', '.join(nodes), fb_mirror.path))
+    try:
+        fb_mirror.run(nodes)
+    except KeyboardInterrupt:
+        fb_mirror.save()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+
+"""
+Thin client for the pygtd daemon (gtdd.py).
+
+Usage:
+    gtdc.py add some text     # add to Inbox
+    gtdc.py -q                # Inbox prompt, for use with a hotkey
+    gtdc.py list [container]  # list Next Actions, or another container
+    gtdc.py complete KEY [container]
+    gtdc.py overview
+
+Only imports what it needs to talk to the socket. If the daemon isn't running,
+new Inbox items are saved with capture instead, so nothing is lost.
+"""
+
+import json
+import os
+import socket
+from sys import argv, exit
+
+SOCKET_FILE = os.environ.get(
+    'PYGTD_SOCKET',
+    os.path.join(os.path.dirname(os.path.realpath(__file__)), 'pygtd.sock'))
+
+
+def request(cmd, **args):
+    """Send request to daemon and return response dict."""
+    args['cmd'] = cmd
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.connect(SOCKET_FILE)
+        s.sendall(json.dumps(args).encode() + b'\n')
+        with s.makefile('rb') as f:
+            line = f.readline()
+    if not line:
+        # Daemon closed the connection without answering.
+        return {'ok': False, 'error': 'pygtd daemon error (no response)'}
+    return json.loads(line)
+
+
+def text_of(value):
+    """Return printable text for an item, whatever container it's from."""
+    if isinstance(value, dict):
+        return value.get('text', str(value))
+    return value
+
+
+def print_items(title, items):
+    print(title)
+    for key, value in items:
+        print('  ' + key + ' ' + text_of(value))
+
+
+def add(text):
+    try:
+        response = request('add', text=text)
+    except OSError:
+        import capture
+        capture.capture(text)
+        print('Daemon not running; item saved for next load: {}'.format(text))
+        return
+    if not response['ok']:
+        exit('Item not added: {}'.format(response['error']))
+    print('Item added to inbox: {}'.format(text))
+    return response
+
+
+def main():
+    if len(argv) < 2:
+        print(__doc__)
+        exit(1)
+    cmd, rest = argv[1], argv[2:]
+
+    if cmd == '-q':
+        add(input('INBOX> '))
+        return
+    if cmd == 'add':
+        add(' '.join(rest))
+        return
+
+    if cmd == 'list':
+        args = {'container': rest[0]} if rest else {}
+    elif cmd == 'complete':
+        args = {'key': rest[0]}
+        if len(rest) > 1:
+            args['container'] = rest[1]
+    else:
+        args = {}
+
+    try:
+        response = request(cmd, **args)
+    except OSError:
+        exit('pygtd daemon is not running. Start it with gtdd.py.')
+    if not response['ok']:
+        exit(response['error'])
+
+    if cmd == 'list':
+        print_items(rest[0] if rest else 'actions', response['items'])
+    elif cmd == 'overview':
+        print_items('Inbox', response['inbox'])
+        print_items('Next Actions', response['actions'])
+        print_items('Projects', response['projects'])
+        print(', '.join('{}: {}'.format(name, n)
+                        for name, n in response['counts'].items()))
+    elif cmd == 'complete':
+        print('Item marked complete.')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+
+"""
+Resident pygtd daemon.
+
+Loads pygtd data once and keeps it in memory, answering requests from gtdc.py
+over a Unix socket so commands don't pay for interpreter startup, imports and
+loading the data file every time. Each change is still written to the journal
+right away; compacting the journal into a snapshot happens in the background.
+
+Requests and responses are one JSON object per line. Requests look like
+{"cmd": "add", "text": "..."}; see COMMANDS for the rest.
+"""
+
+import json
+import os
+import signal
+import socket
+import socketserver
+import threading
+from sys import exit
+from time import time, sleep
+
+import capture
+import journal
+import pygtd
+
+SOCKET_FILE = os.environ.get('PYGTD_SOCKET', str(pygtd.PARENT / 'pygtd.sock'))
+
+# Seconds between background compaction/capture merge passes.
+MAINTENANCE_INTERVAL = 60
+
+lock = threading.Lock()
+
+
+def cmd_add(text):
+    """Add new Inbox item. Return its key."""
+    key = str(time())
+    pygtd.put('inbox', key, text)
+    return {'key': key}
+
+
+def cmd_list(container='actions'):
+    """Return items in container as a list of [key, value] pairs."""
+    return {'items': list(pygtd.data[container].items())}
+
+
+def cmd_complete(key, container='actions'):
+    """Move item to completed list."""
+    pygtd.complete(key, container)
+    return {}
+
+
+def cmd_overview():
+    """Return Inbox, Next Actions and Projects, plus size of every list."""
+    return {
+        'counts': {name: len(pygtd.data[name])
+                   for name in sorted(pygtd.stored_containers())},
+        'inbox': list(pygtd.data['inbox'].items()),
+        'actions': list(pygtd.data['actions'].items()),
+        'projects': list(pygtd.data['projects'].items()),
+    }
+
+
+COMMANDS = {
+    'add': cmd_add,
+    'list': cmd_list,
+    'complete': cmd_complete,
+    'overview': cmd_overview,
+}
+
+
+def handle(request):
+    """Run a single request dict and return response dict."""
+    args = dict(request)
+    name = args.pop('cmd', None)
+    if name not in COMMANDS:
+        return {'ok': False, 'error': 'Unknown command: {}'.format(name)}
+    try:
+        with lock:
+            result = COMMANDS[name](**args)
+    except Exception as e:
+        # Keep serving; the client gets the error instead of no reply.
+        return {'ok': False, 'error': '{}: {}'.format(type(e).__name__, e)}
+    result['ok'] = True
+    return result
+
+
+class Handler(socketserver.StreamRequestHandler):
+    """Answer each JSON line received on the connection."""
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+            except ValueError:
+                response = {'ok': False, 'error': 'Invalid request'}
+            else:
+                response = handle(request)
+            self.wfile.write(json.dumps(response).encode() + b'\n')
+            self.wfile.flush()
+
+
+def compact():
+    """Drop cached containers and fold the journal into the snapshots.
+
+    pygtd.py may have changed the data since it was loaded, so cached
+    containers are read back when next needed, and save_data() compacts from
+    storage under the journal lock. With SQLite every change is already in
+    place, so only the cache is dropped.
+    """
+    pygtd.data.clear()
+    if pygtd.STORAGE != 'sqlite' and journal.length(pygtd.JOURNAL_FILE):
+        pygtd.save_data()
+
+
+def maintenance():
+    """Periodically merge quick_add captures and compact the journal."""
+    while True:
+        sleep(MAINTENANCE_INTERVAL)
+        with lock:
+            capture.drain(lambda items: pygtd.put_many('inbox', items))
+            compact()
+
+
+def remove_stale_socket():
+    """Delete socket file left behind by a daemon that's no longer running."""
+    if not os.path.exists(SOCKET_FILE):
+        return
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        s.connect(SOCKET_FILE)
+    except OSError:
+        os.remove(SOCKET_FILE)
+    else:
+        exit('pygtd daemon already running on ' + SOCKET_FILE)
+    finally:
+        s.close()
+
+
+def main():
+    remove_stale_socket()
+    pygtd.load_data()
+    threading.Thread(target=maintenance, daemon=True).start()
+    server = socketserver.ThreadingUnixStreamServer(SOCKET_FILE, Handler)
+    # Clean up the same way on kill as on Ctrl-C.
+    signal.signal(signal.SIGTERM, lambda signum, frame: exit())
+    print('pygtd daemon listening on ' + SOCKET_FILE)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(SOCKET_FILE)
+        with lock:
+            compact()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,216 @@
+"""
+Append-only journal for pygtd data.
+
+Each mutation is written as one small JSON record per line, so recording a
+change costs the same no matter how much data is stored. Containers are only
+written out in full when the journal is compacted into the snapshot directory,
+which holds one file per container.
+
+Record format:
+    {"op": "put", "c": container, "k": key, "v": value}
+    {"op": "del", "c": container, "k": key}
+    {"op": "clear", "c": container}
+
+Records written together by extend() also carry a batch ID ("b") and are
+followed by {"op": "commit", "b": batch}. Batch records are ignored unless
+their commit record made it to disk, so a batch is applied all or nothing.
+"""
+
+import fcntl
+import json
+import os
+import uuid
+from contextlib import contextmanager
+
+
+def encode(record):
+    """Return record as a single journal line."""
+    return json.dumps(record, separators=(',', ':')) + '\n'
+
+
+@contextmanager
+def locked(path):
+    """Open journal for appending, holding an exclusive lock on it.
+
+    Every write takes the lock, and compaction holds it from reading the
+    journal until truncating it, so records appended by another process (ie
+    pygtd.py while gtdd.py runs) can't be lost in between.
+
+    If the last line was cut short (ie the process was killed mid-write), it's
+    ended first, so the next record starts on a line of its own.
+    """
+    with open(path, 'a+b') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.seek(0, os.SEEK_END)
+        if f.tell():
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b'\n':
+                f.write(b'\n')
+        yield f
+
+
+def append(path, record):
+    """Append one record to the journal and flush it to disk."""
+    with locked(path) as f:
+        f.write(encode(record).encode())
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def extend(path, records):
+    """Append records from an iterable as one batch.
+
+    Return number of records written.
+
+    Records are streamed to the file as they're produced, so memory use
+    doesn't depend on how many there are, and flushed to disk once at the
+    end. The batch only takes effect once its commit record is written, after
+    the last record; if that never happens (ie the process is killed or
+    records raises), none of it does.
+    """
+    batch = uuid.uuid4().hex
+    count = 0
+    with locked(path) as f:
+        for record in records:
+            record['b'] = batch
+            f.write(encode(record).encode())
+            count += 1
+        f.write(encode({'op': 'commit', 'b': batch}).encode())
+        f.flush()
+        os.fsync(f.fileno())
+    return count
+
+
+def apply(data, record):
+    """Apply a single journal record to data dict in place."""
+    op = record['op']
+    container = data.setdefault(record['c'], {})
+    if op == 'put':
+        container[record['k']] = record['v']
+    elif op == 'del':
+        container.pop(record['k'], None)
+    elif op == 'clear':
+        container.clear()
+
+
+def committed(path):
+    """Return set of IDs of batches with a commit record in journal."""
+    batches = set()
+    with open(path, 'r') as f:
+        for line in f:
+            if '"op":"commit"' not in line:
+                continue
+            try:
+                batches.add(json.loads(line)['b'])
+            except ValueError:
+                continue
+    return batches
+
+
+def records(path, container=None, start=0):
+    """Yield records from journal file in order.
+
+    If container is given, only records for that container are parsed and
+    returned. If start is given, reading starts at that byte offset, which
+    should be the end of an earlier read. Partially written lines (ie if the
+    process was killed mid-write) and records of batches that were never
+    committed are skipped rather than treated as an error.
+    """
+    # Cheap substring test to skip parsing records for other containers.
+    tag = ('"c":' + json.dumps(container)).encode() if container else None
+    batches = None
+    try:
+        f = open(path, 'rb')
+    except FileNotFoundError:
+        return
+    with f:
+        f.seek(start)
+        for line in f:
+            if tag and tag not in line:
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if record['op'] == 'commit':
+                continue
+            if 'b' in record:
+                if batches is None:
+                    # Only read when needed; most journals have no batches.
+                    batches = committed(path)
+                if record['b'] not in batches:
+                    continue
+            if container is None or record['c'] == container:
+                yield record
+
+
+def replay(path, data, container=None):
+    """Apply records in journal to data. Return number of records applied.
+
+    If container is given, only records for that container are applied.
+    """
+    count = 0
+    for record in records(path, container):
+        apply(data, record)
+        count += 1
+    return count
+
+
+def length(path):
+    """Return number of records in journal without parsing them."""
+    try:
+        f = open(path, 'rb')
+    except FileNotFoundError:
+        return 0
+    with f:
+        return sum(chunk.count(b'\n') for chunk in iter(
+            lambda: f.read(1 << 16), b''))
+
+
+def containers(path):
+    """Return set of container names that have records in journal."""
+    return {record['c'] for record in records(path)}
+
+
+def read_container(path):
+    """Yield (key, value) pairs from a container snapshot file.
+
+    Snapshots hold one [key, value] JSON array per line, so they can be read
+    one item at a time rather than parsing the whole file at once.
+    """
+    try:
+        f = open(path, 'r')
+    except FileNotFoundError:
+        return
+    with f:
+        for line in f:
+            key, value = json.loads(line)
+            yield key, value
+
+
+def write_container(path, items):
+    """Atomically replace container snapshot file with items dict."""
+    tmp = str(path) + '.tmp'
+    with open(tmp, 'w') as f:
+        for pair in items.items():
+            f.write(json.dumps(pair, separators=(',', ':')) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def compact(snapshot_dir, journal, data):
+    """Fold journal into per-container snapshot files.
+
+    journal is the journal file as opened by locked(), which must have been
+    held since data was read. data must include every container that has
+    records in the journal. Snapshots are written first, then the journal is
+    truncated. If interrupted in between, replaying the old journal on top of
+    the new snapshots gives the same result, since every record is idempotent.
+    """
+    for container, items in data.items():
+        write_container(os.path.join(snapshot_dir, container + '.jsonl'),
+                        items)
+    journal.truncate(0)
+    journal.flush()
+    os.fsync(journal.fileno())
@@ -0,0 +1,237 @@
+"""
+Local mirror of Google Tasks and Calendar data for oopygtd.
+
+The first sync downloads everything. After that only changes cross the wire:
+tasks are listed with updatedMin (including deleted and completed ones, which
+are dropped from the mirror), and events with the sync token Calendar returned
+last time. Changes are patched into the mirror in place.
+"""
+
+import datetime
+import json
+import search
+import sqlite3
+import timing
+from inspect import currentframe, getframeinfo
+from pathlib import Path
+from time import time
+
+FILENAME = getframeinfo(currentframe()).filename
+PARENT = Path(FILENAME).resolve().parent
+MIRROR_FILE = PARENT / 'mirror.db'
+
+# Seconds subtracted from the last sync time when asking for changed tasks, in
+# case the local clock is ahead of Google's.
+CLOCK_SKEW = 5 * 60
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS tasks (
+    id TEXT PRIMARY KEY,
+    bucket TEXT NOT NULL,
+    position TEXT,
+    body TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS tasks_bucket ON tasks (bucket, position);
+CREATE TABLE IF NOT EXISTS events (
+    id TEXT PRIMARY KEY,
+    start REAL NOT NULL,
+    body TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS events_start ON events (start);
+CREATE TABLE IF NOT EXISTS state (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+'''
+
+
+def connect():
+    """Open mirror database. Each thread needs its own connection."""
+    conn = sqlite3.connect(str(MIRROR_FILE), timeout=30)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def get_state(conn, key):
+    row = conn.execute('SELECT value FROM state WHERE key = ?',
+                       (key,)).fetchone()
+    return row[0] if row else None
+
+
+def set_state(conn, key, value):
+    conn.execute('INSERT OR REPLACE INTO state VALUES (?, ?)', (key, value))
+
+
+def synced_at(conn):
+    """Return time of the least recent sync, or None if never synced.
+
+    A list (or the calendar) changed since it was last synced counts as
+    synced at time 0, ie out of date.
+    """
+    stale = conn.execute(
+        "SELECT 1 FROM state AS changed JOIN state AS synced "
+        "ON synced.key = substr(changed.key, 9) "
+        "WHERE changed.key LIKE 'changed:%' "
+        "AND CAST(changed.value AS REAL) > CAST(synced.value AS REAL)"
+    ).fetchone()
+    row = conn.execute(
+        "SELECT MIN(CAST(value AS REAL)) FROM state "
+        "WHERE key LIKE 'tasks_synced:%' OR key = 'events_synced'").fetchone()
+    if stale and row[0] is not None:
+        return 0.0
+    return row[0]
+
+
+def mark_changed(conn, key):
+    """Note that data was changed on Google, ie by opqueue.
+
+    key is the state key of what changed, ie 'tasks_synced:inbox' or
+    'events_synced'. The mirror counts as out of date until it's synced again.
+    """
+    set_state(conn, 'changed:' + key, str(time()))
+
+
+def rfc3339(timestamp):
+    """Return Unix timestamp as RFC 3339 UTC string."""
+    dt = datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc)
+    return dt.strftime('%Y-%m-%dT%H:%M:%S.000Z')
+
+
+def event_start(event):
+    """Return event start as Unix timestamp.
+
+    All-day events (start 'date' rather than 'dateTime') start at local
+    midnight.
+    """
+    from dateutil import parser
+    start = event['start']
+    return parser.parse(start.get('dateTime') or start['date']).timestamp()
+
+
+@timing.span('mirror.tasks', 'storage')
+def tasks(conn, bucket):
+    """Return tasks in list from mirror, in Google's order."""
+    rows = conn.execute(
+        'SELECT body FROM tasks WHERE bucket = ? ORDER BY position',
+        (bucket,))
+    return [json.loads(body) for body, in rows]
+
+
+@timing.span('mirror.events', 'storage')
+def events(conn, days=None):
+    """Return future events from mirror in order of start time.
+
+    If days is given, only events starting within that many days.
+    """
+    now = time()
+    end = now + days * 24 * 60 * 60 if days is not None else float('inf')
+    rows = conn.execute(
+        'SELECT body FROM events WHERE start >= ? AND start < ? '
+        'ORDER BY start', (now, end))
+    return [json.loads(body) for body, in rows]
+
+
+@timing.span('mirror.apply_tasks', 'storage')
+def apply_tasks(conn, bucket, items, full=False):
+    """Patch tasks in list with items from Google. Return number applied.
+
+    Deleted, hidden and completed tasks are removed. If full, items is the
+    whole list, so anything not in it is removed too. The search index is
+    updated to match.
+
+    items should already be downloaded (ie a list rather than a generator
+    fetching pages), since the mirror stays locked while they're applied.
+    """
+    added = []
+    removed = []
+    with conn:
+        if full:
+            conn.execute('DELETE FROM tasks WHERE bucket = ?', (bucket,))
+        for item in items:
+            if (item.get('deleted') or item.get('hidden')
+                    or item.get('status') == 'completed'):
+                conn.execute('DELETE FROM tasks WHERE id = ?', (item['id'],))
+                removed.append(item['id'])
+            else:
+                conn.execute('INSERT OR REPLACE INTO tasks VALUES (?, ?, ?, ?)',
+                             (item['id'], bucket, item.get('position'),
+                              json.dumps(item)))
+                added.append(item)
+    # Indexed afterwards, in its own transaction, so the mirror isn't locked
+    # any longer than needed.
+    index = search.connect()
+    with index:
+        if full:
+            search.clear(index, 'google', bucket)
+        for id in removed:
+            search.remove(index, 'google', bucket, id)
+        for item in added:
+            search.add(index, 'google', bucket, item['id'], item)
+    index.close()
+    return len(added) + len(removed)
+
+
+@timing.span('mirror.apply_events', 'storage')
+def apply_events(conn, items, full=False):
+    """Patch events with items from Google. Return number applied.
+
+    Cancelled events are removed, as are events that have already started
+    more than a day ago. If full, anything not in items is removed too.
+    """
+    with conn:
+        if full:
+            conn.execute('DELETE FROM events')
+        for item in items:
+            if item.get('status') == 'cancelled':
+                conn.execute('DELETE FROM events WHERE id = ?', (item['id'],))
+            else:
+                conn.execute('INSERT OR REPLACE INTO events VALUES (?, ?, ?)',
+                             (item['id'], event_start(item), json.dumps(item)))
+        conn.execute('DELETE FROM events WHERE start < ?',
+                     (time() - 24 * 60 * 60,))
+    return len(items)
+
+
+@timing.span('mirror.sync_tasks', 'sync')
+def sync_tasks(conn, bucket):
+    """Bring mirror of task list up to date. Return number of changes."""
+    # Imported here so reading the mirror doesn't pay for API setup.
+    import quickstart
+
+    key = 'tasks_synced:' + bucket
+    last = get_state(conn, key)
+    started = time()
+    # Download every page before writing, so the mirror's write lock isn't
+    # held while waiting on the network, which would hold up other lists.
+    if last is None:
+        items = list(quickstart.iter_g_tasks(bucket))
+    else:
+        since = rfc3339(float(last) - CLOCK_SKEW)
+        items = list(quickstart.iter_g_task_changes(bucket, since))
+    n = apply_tasks(conn, bucket, items, full=last is None)
+    with conn:
+        set_state(conn, key, str(started))
+    return n
+
+
+@timing.span('mirror.sync_events', 'sync')
+def sync_events(conn):
+    """Bring mirror of calendar up to date. Return number of changes."""
+    import quickstart
+
+    token = get_state(conn, 'events_sync_token')
+    try:
+        items, next_token = quickstart.sync_events(token)
+    except Exception as e:
+        status = getattr(getattr(e, 'resp', None), 'status', None)
+        if not token or status != 410:
+            raise
+        # Sync token expired; start over with a full sync.
+        token = None
+        items, next_token = quickstart.sync_events()
+    n = apply_events(conn, items, full=token is None)
+    with conn:
+        set_state(conn, 'events_sync_token', next_token)
+        set_state(conn, 'events_synced', str(time()))
+    return n
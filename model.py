@@ -0,0 +1,115 @@
+"""
+Compact item types for the oopygtd containers.
+
+Google and Firebase hand back a dict per item with every API field. Task and
+Event keep only the fields the app uses, in __slots__ rather than a per-item
+dict, and intern the list and status strings (there are only a handful of
+distinct values, shared by every item). from_api() and to_api() convert to and
+from the wire format.
+"""
+
+from sys import intern
+
+
+def interned(value):
+    """Return interned copy of string, or None."""
+    return intern(value) if value is not None else None
+
+
+class Task():
+    """Google Tasks item (also used for the Firebase nodes)."""
+
+    __slots__ = ('id', 'list', 'title', 'notes', 'status', 'due', 'parent',
+                 'position', 'completed', 'indent')
+
+    # Fields copied as is to and from the API dict.
+    API_FIELDS = ('id', 'title', 'notes', 'due', 'parent', 'position',
+                  'completed')
+
+    def __init__(self, title, id=None, list=None, notes=None, status=None,
+                 due=None, parent=None, position=None, completed=None,
+                 indent=0):
+        self.id = id
+        self.list = interned(list)
+        self.title = title
+        self.notes = notes
+        self.status = interned(status)
+        self.due = due
+        self.parent = parent
+        self.position = position
+        self.completed = completed
+        self.indent = indent
+
+    def __repr__(self):
+        return f'Task({self.title!r}, id={self.id!r}, list={self.list!r})'
+
+    @classmethod
+    def from_api(cls, item, list=None):
+        """Create Task from API dict for task in given list.
+
+        Old Firebase items have 'text' rather than 'title'.
+        """
+        task = cls(item.get('title') or item.get('text') or '', list=list,
+                   status=item.get('status'))
+        for field in ('id', 'notes', 'due', 'parent', 'position', 'completed'):
+            setattr(task, field, item.get(field))
+        return task
+
+    def to_api(self):
+        """Return task as API dict, leaving out empty fields."""
+        item = {field: getattr(self, field) for field in self.API_FIELDS
+                if getattr(self, field) is not None}
+        if self.status:
+            item['status'] = self.status
+        return item
+
+
+def aware(value):
+    """Parse date/time string into timezone-aware datetime.
+
+    Times without an offset (including bare dates, ie all-day events) are
+    taken to be local.
+    """
+    from dateutil import parser
+    when = parser.parse(value)
+    return when if when.tzinfo else when.astimezone()
+
+
+class Event():
+    """Google Calendar event.
+
+    start is the event's 'date' (all-day events) or 'dateTime' string, and
+    when is the same time parsed once into an aware datetime.
+    """
+
+    __slots__ = ('id', 'summary', 'start', 'when', 'all_day', 'status')
+
+    def __init__(self, summary, start, all_day=False, id=None, status=None):
+        self.id = id
+        self.summary = summary
+        self.start = start
+        self.when = aware(start)
+        self.all_day = all_day
+        self.status = interned(status)
+
+    def __repr__(self):
+        return f'Event({self.summary!r}, {self.start!r}, id={self.id!r})'
+
+    @classmethod
+    def from_api(cls, item):
+        """Create Event from API dict."""
+        start = item['start']
+        all_day = 'dateTime' not in start
+        return cls(item.get('summary', ''),
+                   start['date'] if all_day else start['dateTime'],
+                   all_day, item.get('id'), item.get('status'))
+
+    def to_api(self):
+        """Return event as API dict, leaving out empty fields."""
+        item = {'summary': self.summary,
+                'start': {'date' if self.all_day else 'dateTime': self.start}}
+        if self.id is not None:
+            item['id'] = self.id
+        if self.status:
+            item['status'] = self.status
+        return item
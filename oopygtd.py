@@ -6,28 +6,29 @@ I'll use shelf for storage.
 """
 
 import argparse
+import atexit
+import fbmirror
+import hashlib
 import json
-import pyperclip
 import datetime
 import re
-import shelve
-import jsonpickle
-import quickstart
-from os import path
+import search
+import mirror
+from model import Event, Task
+import opqueue
+from os import path, environ
 from time import time, sleep
 from sys import stdout, argv, exit
-from dateutil import parser
 from inspect import currentframe, getframeinfo
 from pathlib import Path
 from operator import attrgetter
+from bisect import bisect_left, bisect_right
 from collections import deque
 from math import floor
-import pyrebase
 import secrets
-from copy import deepcopy
-import pprint
+from tasktree import TaskTree
 import threading
-from cursesmenu import CursesMenu, SelectionMenu
+import timing
 from termcolor import colored, cprint
 # from cursesmenu.items import FunctionItem
 
@@ -36,6 +37,26 @@ FILENAME = getframeinfo(currentframe()).filename
 PARENT = Path(FILENAME).resolve().parent
 DATA_FILE = PARENT / 'pygtd.json'
 PICKLE_FILE = PARENT / 'pickle.json'
+FB_MANIFEST_FILE = PARENT / 'fb_manifest.json'
+TODOSH_FILE = PARENT / 'pygtd.txt'
+
+# Google Tasks lists, in the order they're merged and displayed.
+TASK_BUCKETS = ['inbox', 'next_actions', 'projects', 'maybe_someday',
+                'waiting_for']
+# How far ahead to fetch and show calendar events.
+CALENDAR_DAYS = 30
+# Firebase nodes exported from containers with the same name. ('calendar' is
+# exported too, but its items are a list rather than a dict.)
+FB_NODES = ['inbox', 'next_actions', 'waiting_for', 'projects',
+            'maybe_someday', 'completed_items']
+# Nodes that are only kept in Firebase, not Google, so they're imported along
+# with the Google data. Otherwise the next export would delete them.
+FB_ONLY_NODES = ['completed_items']
+# If set, fb_import() reads from the local mirror kept up to date by
+# fbmirror.py rather than from Firebase.
+FB_MIRROR = environ.get('PYGTD_FB_MIRROR')
+# Seconds for which the local mirror is used as is, without syncing first.
+CACHE_TTL = int(environ.get('PYGTD_CACHE_TTL', 300))
 
 
 def print_reverse(x): return cprint(x, attrs=['reverse'])
@@ -47,9 +68,6 @@ def print_red(x): return cprint(x, 'red', attrs=['bold'])
 def print_yellow(x): return cprint(x, 'yellow', attrs=['bold'])
 
 
-# just so I don't have to type it again
-pp = pprint.PrettyPrinter()
-
 # Firebase
 SERVICE_ACCOUNT_CREDENTIALS = PARENT / 'pygtd-7b396b5dc2be.json'
 
@@ -61,11 +79,42 @@ config = {
     "serviceAccount": SERVICE_ACCOUNT_CREDENTIALS
 }
 
-firebase = pyrebase.initialize_app(config)
-auth = firebase.auth()  # authenticate a user
-user = auth.sign_in_with_email_and_password(
-    secrets.email, secrets.password)
-db = firebase.database()
+# Firebase database and signed-in user, set by get_firebase() when first
+# needed. Signing in takes a few round trips, which commands that only talk to
+# Google (ie -i) shouldn't wait for.
+firebase = None
+firebase_auth = None
+firebase_lock = threading.Lock()
+
+
+def get_firebase():
+    """Return Firebase database and user, signing in the first time."""
+    global firebase, firebase_auth
+    with firebase_lock:
+        if firebase is None:
+            import pyrebase
+            with timing.span('firebase auth', 'network'):
+                app = pyrebase.initialize_app(config)
+                firebase_auth = app.auth()  # authenticate a user
+                user = firebase_auth.sign_in_with_email_and_password(
+                    secrets.email, secrets.password)
+                firebase = (app.database(), user)
+    return firebase
+
+
+def refresh_firebase():
+    """Get a new ID token for the Firebase user. Return database and user.
+
+    ID tokens expire after an hour, so long-running processes (ie fbmirror.py)
+    need to refresh them.
+    """
+    global firebase
+    db, user = get_firebase()
+    with firebase_lock:
+        with timing.span('firebase refresh', 'network'):
+            tokens = firebase_auth.refresh(user['refreshToken'])
+        firebase = (db, dict(user, **tokens))
+    return firebase
 
 
 def timedif(then):
@@ -82,6 +131,7 @@ def confirm_date_parse():
     correctly before continuing.
 
     """
+    from dateutil import parser
     ok = False
     while not ok:
         date = input("Date (and time, optional)\nAny format should work:\n> ")
@@ -109,6 +159,26 @@ def center_print(title, pad='*', size=80):
     print_reverse(text)
 
 
+def write_if_changed(filename, content):
+    """Write bytes to file unless it already holds them. Return True if so.
+
+    Writes go to a temporary file that is then renamed over the original, so
+    readers see either the old or the new file, never part of one.
+    """
+    digest = hashlib.sha1(content).hexdigest()
+    try:
+        with open(filename, 'rb') as f:
+            if hashlib.sha1(f.read()).hexdigest() == digest:
+                return False
+    except FileNotFoundError:
+        pass
+    tmp = filename.with_suffix(filename.suffix + '.tmp')
+    with open(tmp, 'wb') as f:
+        f.write(content)
+    tmp.replace(filename)
+    return True
+
+
 def timer(seconds):
     """Display countdown for specified time."""
 
@@ -146,13 +216,13 @@ class Inbox():
             'title': text,
         }
         # self.items[created] = item
-        quickstart.save_g_task(item, 'inbox')
+        opqueue.submit('insert', 'inbox', body=item)
 
     def print(self):
         """Print Inbox item."""
 
         for _, item in self.items.items():
-            print(item['title'])
+            print(item.title)
 
     def quickadd(self):
         """Display a prompt to add new Inbox item.
@@ -165,6 +235,7 @@ class Inbox():
 
     def paste(self):
         """Save clipboard contents as new Inbox item."""
+        import pyperclip
         self.add(pyperclip.paste())
 
 
@@ -181,14 +252,12 @@ class NextActionList():
             'title': text
         }
         # self.items[created] = newitem
-        quickstart.save_g_task(newitem, 'next_actions')
+        opqueue.submit('insert', 'next_actions', body=newitem)
 
     def print(self):
         """Print Next Action."""
-        for _, item in self.items.items():
-            indent = '    ' * item.get('indent')
-            text = indent + item.get('title')
-            print(text)
+        for depth, item in TaskTree(self.items.values()).walk():
+            print('    ' * depth + item.title)
 
     def i_new_item(self, created=None):
         """Create new item with interactive prompt."""
@@ -220,13 +289,14 @@ class WaitingForList():
         if due:
             newitem['due'] = due
         # self.items[created] = newitem
-        quickstart.save_g_task(newitem, 'waiting_for')
+        opqueue.submit('insert', 'waiting_for', body=newitem)
 
     def print(self):
         """Print Waiting For items."""
+        from dateutil import parser
 
         for _, item in self.items.items():
-            due = item.get('due')
+            due = item.due
             days = None
             if due:
                 date = parser.parse(due)
@@ -236,7 +306,7 @@ class WaitingForList():
                 except TypeError:
                     today = datetime.datetime.now(datetime.timezone.utc)
                     days = (date - today).days
-            text = '...' + item['title']
+            text = '...' + item.title
             if days:
                 text += ' in ' + str(days) + ' days'
             print(text)
@@ -263,6 +333,7 @@ class ProjectList():
 
     def add(self, text, title=None, created=None, next_actions=[]):
         # created = created or str(time()).replace('.', '-')
+        import pprint
         pp = pprint.PrettyPrinter()
         newitem = {
             'title': text,
@@ -271,13 +342,11 @@ class ProjectList():
         if title:
             newitem['title'] = f'[{title}] ' + text
         # self.items.append(newitem)
-        quickstart.save_g_task(newitem, 'projects')
+        opqueue.submit('insert', 'projects', body=newitem)
 
     def print(self):
-        for _, item in self.items.items():
-            indent = '    ' * item.get('indent')
-            text = indent + item.get('title')
-            print(text)
+        for depth, item in TaskTree(self.items.values()).walk():
+            print('    ' * depth + item.title)
             # TODO: print next action
 
     def i_new_item(self, created=None):
@@ -303,21 +372,43 @@ class MaybeSomedayList():
             'title': text,
         }
         # self.items[created] = newitem
-        quickstart.save_g_task(newitem, 'maybe_someday')
+        opqueue.submit('insert', 'maybe_someday', body=newitem)
 
     def print(self):
         for _, item in self.items.items():
-            print(item['text'])
+            print(item.title)
 
 
 class Calendar():
-    """Create container for Calendar items."""
+    """Create container for Calendar items.
+
+    Events are kept sorted by start time, with a parallel list of start times
+    so a time window can be found by bisection.
+
+    """
 
     def __init__(self, items=[]):
-        self.items = items
+        self.load(items)
+
+    def load(self, items):
+        """Replace events with items (Event objects, in any order)."""
+        self.items = sorted(items, key=attrgetter('when'))
+        self.starts = [item.when for item in self.items]
 
     def add(self, item):
-        self.items.append(item)
+        index = bisect_right(self.starts, item.when)
+        self.starts.insert(index, item.when)
+        self.items.insert(index, item)
+
+    def between(self, start, end):
+        """Return events starting at or after start and before end."""
+        return self.items[bisect_left(self.starts, start):
+                          bisect_left(self.starts, end)]
+
+    def upcoming(self, days):
+        """Return events starting from now until given number of days."""
+        now = datetime.datetime.now(datetime.timezone.utc)
+        return self.between(now, now + datetime.timedelta(days=days))
 
     def i_new_item(self, created=None):
         """Interactively create new Calendar item in Google Calendar.
@@ -325,6 +416,7 @@ class Calendar():
         If no time is entered or time is 12:00AM, will assume all-day event.
         Otherwise, a one-hour-long event will be created.
         """
+        from dateutil import parser
 
         text = input("Describe scheduled item:\n> ")
         ok = False
@@ -338,52 +430,42 @@ class Calendar():
             isok = input("Ok? (y/n)").lower()
             if 'y' in isok:
                 ok = True
-        quickstart.save_event(text, when)
+        opqueue.submit('event', body={'summary': text,
+                                      'date_time': when.isoformat()})
         print('New item added to Calendar.')
 
-    def print_upcoming(self, period=30):
+    def print_upcoming(self, period=CALENDAR_DAYS):
         """Print Calendar items.
 
         Print all future calendar items within given number of days, the
         date/time at which they occur, and the time between now and then.
 
         """
-        for item in self.items:
-            # Google Calendar may give start and end times with key 'date' or
-            # 'dateTime', depending on how event is entered.
-            try:
-                date = parser.parse(item['start']['date'])
-            except KeyError:
-                date = parser.parse(item['start']['dateTime'])
-            try:
-                today = datetime.datetime.today()
-                delta = date - today
-            except TypeError:
-                today = datetime.datetime.now(datetime.timezone.utc)
-                delta = date - today
+        # delta.days <= period, ie up to the end of the last day of period.
+        now = datetime.datetime.now(datetime.timezone.utc)
+        for item in self.upcoming(period + 1):
+            date = item.when
+            delta = date - now
             days = delta.days
-            # only print dates that are not in the past and in specified range
-            if days <= period and date >= today:
-                dates = date.strftime('%a, %b %d')
-                times = date.strftime('%I:%M%p')
-                # If time in datetime object is 00:00, assume specific time was
-                # not entered or desired.
-                if not times == '12:00AM':
-                    dates += ' ' + times
-                hours = round(delta.seconds / 3600)
-                text = '{{{}}} {} ({} days, {} hours)'.format(
-                    dates,
-                    item['summary'],
-                    days,
-                    hours
-                )
-                if days < 2:
-                    print_red(text)
-                elif days < 7:
-                    print_yellow(text)
-                else:
-                    print(text)
-        # TODO: test if date is within days or less in the future
+            dates = date.strftime('%a, %b %d')
+            times = date.strftime('%I:%M%p')
+            # If time in datetime object is 00:00, assume specific time was
+            # not entered or desired.
+            if not times == '12:00AM':
+                dates += ' ' + times
+            hours = round(delta.seconds / 3600)
+            text = '{{{}}} {} ({} days, {} hours)'.format(
+                dates,
+                item.summary,
+                days,
+                hours
+            )
+            if days < 2:
+                print_red(text)
+            elif days < 7:
+                print_yellow(text)
+            else:
+                print(text)
 
 
 class CompletedItemList():
@@ -398,18 +480,12 @@ class CompletedItemList():
 
     def add(self, text, completed, created=None):
         created = created or str(time()).replace('.', '-')
-        newitem = {
-            'text': text,
-            'completed': completed,
-        }
-        self.items[created] = newitem
+        self.items[created] = Task(text, list='completed_items',
+                                   status='completed', completed=completed)
 
     def print(self):
         for _, item in self.items.items():
-            try:
-                print(item['text'])
-            except KeyError:
-                print(item['title'])
+            print(item.title)
 
 
 class GTD():
@@ -433,115 +509,220 @@ class GTD():
             'completed_items': CompletedItemList()
         }
 
+    def fb_paths(self):
+        """Return all exported items as a dict keyed by Firebase path."""
+        nodes = {node: self.d[node].items for node in FB_NODES}
+        nodes['calendar'] = {item.id: item
+                             for item in self.d['calendar'].items}
+        return {f'{node}/{key}': item.to_api()
+                for node, items in nodes.items()
+                for key, item in items.items()}
+
+    @timing.span('fb_export', 'network')
     def fb_export(self):
-        """Save all data to Firebase.
+        """Save changes to Firebase.
 
-        Overwrite each node (inbox, etc) with current data so deletions will be
-        reflected. Assumes all current has already been loaded and any changes
-        between database and current app data (including deletions) are
-        intentional. Otherwise data might be deleted!
+        Each item is compared against the content hashes recorded by the last
+        export (in FB_MANIFEST_FILE), and only added, changed and deleted items
+        are sent, as one multi-path update. Deletions are reflected only for
+        items this machine exported before; assumes all current data has
+        already been loaded, otherwise data might be deleted!
 
         """
-        # Overwrite all nodes in firebase with current data
-        db.child('inbox').set(self.d['inbox'].items, user['idToken'])
-        db.child('next_actions').set(
-            self.d['next_actions'].items, user['idToken'])
-        db.child('waiting_for').set(
-            self.d['waiting_for'].items, user['idToken'])
-        db.child('projects').set(self.d['projects'].items, user['idToken'])
-        db.child('maybe_someday').set(
-            self.d['maybe_someday'].items, user['idToken'])
-        db.child('completed_items').set(
-            self.d['completed_items'].items, user['idToken'])
-        calendar = {}
-        for item in self.d['calendar'].items:
-            itemID = item['id']
-            record = item
-            calendar[itemID] = record
-        db.child('calendar').set(calendar, user['idToken'])
+        try:
+            with open(FB_MANIFEST_FILE, 'r') as f:
+                manifest = json.load(f)
+        except (FileNotFoundError, ValueError):
+            manifest = {}
+
+        hashes = {}
+        updates = {}
+        for path, item in self.fb_paths().items():
+            content = json.dumps(item, sort_keys=True).encode()
+            hashes[path] = hashlib.sha1(content).hexdigest()
+            if manifest.get(path) != hashes[path]:
+                updates[path] = item
+        for path in manifest.keys() - hashes.keys():
+            updates[path] = None  # deletes path
+
+        if updates:
+            db, user = get_firebase()
+            with timing.span('firebase update', 'network',
+                             items=len(updates)):
+                db.update(updates, user['idToken'])
+        tmp = FB_MANIFEST_FILE.with_suffix('.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(hashes, f)
+        tmp.replace(FB_MANIFEST_FILE)
+        return len(updates)
 
     def save_all_g_tasks(self):
         print('about to save g tasks')
         list = 'next_actions'
         for _, item in self.d[list].items.items():
             print('saving item...')
-            print(item['text'])
+            print(item.title)
             # due = parser.parse(item['due']).isoformat() + '-04:00'
             task = {
-                'title': item['text']
+                'title': item.title
                 # 'title': item['text'] + ' from ' + item['who']
             }
-            quickstart.save_g_task(task, list)
+            opqueue.submit('insert', list, body=task)
 
-    def fb_import(self):
-        """Load all data from Firebase."""
+    @timing.span('fb_import', 'network')
+    def fb_import(self, nodes=FB_NODES, network=True):
+        """Load data from Firebase.
 
-        data = db.get(user['idToken']).val()
-        try:
-            self.d['inbox'].items = deepcopy(data['inbox'])
-        except KeyError:
-            pass
-        try:
-            self.d['next_actions'].items = deepcopy(data['next_actions'])
-        except KeyError:
-            pass
-        try:
-            self.d['waiting_for'].items = deepcopy(data['waiting_for'])
-        except KeyError:
-            pass
-        try:
-            self.d['projects'].items = deepcopy(data['projects'])
-        except KeyError:
-            pass
-        try:
-            self.d['maybe_someday'].items = deepcopy(data['maybe_someday'])
-        except KeyError:
-            pass
-        try:
-            self.d['completed_items'].items = deepcopy(data['completed_items'])
-        except KeyError:
-            pass
+        Only the given nodes (by default all but the calendar) are downloaded,
+        one request each, and the decoded items go straight into the
+        containers as Task and Event objects. Nodes missing from Firebase
+        leave their container as is.
 
+        With FB_MIRROR set, data is read from the local mirror instead, which
+        never waits on the network, as long as fbmirror.py is keeping it
+        current. If network is False, nothing is read unless it is.
+        """
+        fb_mirror = fbmirror.FirebaseMirror() if FB_MIRROR else None
+        if not network and not (fb_mirror and fb_mirror.current()):
+            return
+        if fb_mirror and not fb_mirror.current():
+            print('Firebase mirror is out of date (is fbmirror.py running?); '
+                  'reading from Firebase.')
+            fb_mirror = None
+        for node in nodes:
+            if fb_mirror:
+                items = fb_mirror.node(node)
+            else:
+                db, user = get_firebase()
+                with timing.span('firebase get', 'network', node=node):
+                    items = db.child(node).get(user['idToken']).val()
+            if items is None:
+                continue
+            if node == 'calendar':
+                self.d[node].load(Event.from_api(item)
+                                  for item in items.values())
+            else:
+                self.d[node].items = {key: Task.from_api(item, node)
+                                      for key, item in items.items()}
+
+    @timing.span('fetch_g_cal', 'sync')
     def fetch_g_cal(self):
-        """Get events from Google Calendar API."""
+        """Get events from Google Calendar API.
 
-        self.d['calendar'].items = quickstart.get_events(10)
+        Only events changed since the last run are downloaded; the rest come
+        from the local mirror.
+        """
+        conn = mirror.connect()
+        mirror.sync_events(conn)
+        self.load_g_events(mirror.events(conn, CALENDAR_DAYS))
+        conn.close()
 
+    @timing.span('fetch_g_tasks', 'sync')
     def fetch_g_tasks(self):
-        """Get tasks from Google Tasks API."""
-        buckets = ['inbox', 'next_actions', 'projects',
-                   'maybe_someday', 'waiting_for']
-
-        for bucket in buckets:
-            items = quickstart.fetch_g_tasks(bucket)
-            if items:
-                for item in items:
-                    self.d[bucket].items[item['id']] = item
-                    # set indent levels. Assuming tasks are in order, if a task is
-                    # indented, we should have already processed its parent(s)
-                    parent = item.get('parent')
-                    if not parent:
-                        # it's a top-level item: set indent to 0
-                        self.d[bucket].items[item['id']].update({'indent': 0})
-                    else:
-                        # it's a child item; find its parent (which should have
-                        # already been processed) to get indent level
-                        parent_indent = self.d[bucket].items[parent].get(
-                            'indent')
-                        indent = parent_indent + 1
-                        self.d[bucket].items[item['id']].update(
-                            {'indent': indent})
+        """Get tasks from Google Tasks API.
+
+        All lists are synced concurrently, each into its own container. Only
+        tasks changed since the last run are downloaded; the rest come from
+        the local mirror.
+        """
+        from concurrent.futures import ThreadPoolExecutor
+
+        def fetch(bucket):
+            with timing.span('fetch bucket', 'sync', bucket=bucket):
+                conn = mirror.connect()
+                mirror.sync_tasks(conn, bucket)
+                self.load_g_tasks(bucket, mirror.tasks(conn, bucket))
+                conn.close()
+
+        with ThreadPoolExecutor(len(TASK_BUCKETS)) as pool:
+            list(pool.map(fetch, TASK_BUCKETS))
+
+    @timing.span('load_g_tasks')
+    def load_g_tasks(self, bucket, items):
+        """Store tasks from Google in container, setting indent levels.
+
+        Tasks may be in any order; a child can come before its parent. They're
+        stored in display order, each subtask following its parent.
+        """
+        tree = TaskTree(Task.from_api(item, bucket) for item in items)
+        tasks = {}
+        for depth, task in tree.walk():
+            task.indent = depth
+            tasks[task.id] = task
+        self.d[bucket].items = tasks
+
+    def load_g_events(self, items):
+        """Store events from Google in calendar container."""
+        self.d['calendar'].load(Event.from_api(item) for item in items)
+
+    @timing.span('load_mirror', 'storage')
+    def load_mirror(self):
+        """Fill containers from local mirror without touching the network.
+
+        Firebase-only nodes are read too if fbmirror.py is keeping its mirror
+        current (see FB_MIRROR).
+        """
+        conn = mirror.connect()
+        for bucket in TASK_BUCKETS:
+            self.load_g_tasks(bucket, mirror.tasks(conn, bucket))
+        self.load_g_events(mirror.events(conn, CALENDAR_DAYS))
+        conn.close()
+        self.fb_import(FB_ONLY_NODES, network=False)
+
+    def cache_age(self):
+        """Return seconds since mirror was last synced, or None if never."""
+        conn = mirror.connect()
+        synced = mirror.synced_at(conn)
+        conn.close()
+        return None if synced is None else time() - synced
+
+    def fingerprint(self):
+        """Return string that changes whenever any fetched data changes."""
+        items = [[item.to_api() for item in self.d[bucket].items.values()]
+                 for bucket in TASK_BUCKETS]
+        items.append([item.to_api() for item in self.d['calendar'].items])
+        return json.dumps(items, sort_keys=True)
 
     def fetch_all(self):
-        """Get data from all sources."""
+        """Get data from all sources.
 
-        # Get from firebase
-        # self.fb_import()
+        Calendar, task lists and Firebase-only nodes are fetched at the same
+        time, so this takes about as long as the slowest request rather than
+        all of them together.
+        """
+        from concurrent.futures import ThreadPoolExecutor
 
-        # Get from Google
-        self.fetch_g_cal()
-        self.fetch_g_tasks()
+        with ThreadPoolExecutor(2) as pool:
+            firebase = pool.submit(self.fb_import, FB_ONLY_NODES)
+            calendar = pool.submit(self.fetch_g_cal)
+            self.fetch_g_tasks()
+            calendar.result()
+            firebase.result()
 
+    def search_tasks(self, text):
+        """Print tasks in any list matching text, best matches first.
+
+        Searches the local mirror, along with changes not yet sent, so it
+        doesn't wait on the network.
+        """
+        index = search.connect()
+        if not search.built(index, 'google'):
+            # Index tasks mirrored before there was an index.
+            conn = mirror.connect()
+            items = ((bucket, item['id'], item) for bucket in TASK_BUCKETS
+                     for item in mirror.tasks(conn, bucket))
+            search.build(index, 'google', items)
+            conn.close()
+        opqueue.index_pending(index)
+        results = search.query(index, 'google', text)
+        index.close()
+        for bucket, _, item in results:
+            print('[{}] {}'.format(bucket.replace('_', ' ').title(), item))
+        if not results:
+            print('No tasks match "{}".'.format(text))
+        return results
+
+    @timing.span('print_overview', 'render')
     def print_overview(self):
         """Call the print methods for container objects."""
 
@@ -559,6 +740,7 @@ class GTD():
 
     def process_inbox(self):
         """Display interactive prompts for user to process inbox items."""
+        from cursesmenu import SelectionMenu
 
         # FIFO. For each item, the user will be guided
         # by interactive prompts to create a new item based on inbox item. New
@@ -572,7 +754,7 @@ class GTD():
 
         while len(inbox):
             key = inbox[0]
-            menu_title = f"[Inbox Item]: {d[key]['title']}"
+            menu_title = f"[Inbox Item]: {d[key].title}"
             menu_subtitle = f"What is it? ({len(inbox)-1} items remaining)')"
             selections = [
                 ("Next Action: It can be done in one step"),  # 0
@@ -596,7 +778,7 @@ class GTD():
             if selection == 0:  # Next Action
                 self.d['next_actions'].i_new_item(key)
                 taskID = inbox.popleft()
-                quickstart.delete_g_task(taskID, 'inbox')
+                opqueue.submit('delete', 'inbox', task=taskID)
                 continue
             elif selection == 1:  # Do in 2 Min
                 print("Do it now!")
@@ -605,28 +787,28 @@ class GTD():
                 done = input("Done? (y/n): ").lower()
                 if 'y' in done:
                     taskID = inbox.popleft()
-                    quickstart.complete_g_task(taskID, 'inbox')
+                    opqueue.submit('complete', 'inbox', task=taskID)
                 else:
                     continue  # repeat loop with same item
             elif selection == 2:  # Calendar
                 self.d['calendar'].i_new_item(key)
                 taskID = inbox.popleft()
-                quickstart.delete_g_task(taskID, 'inbox')
+                opqueue.submit('delete', 'inbox', task=taskID)
                 continue
             elif selection == 3:  # Waiting For
                 self.d['waiting_for'].i_new_item(key)
                 taskID = inbox.popleft()
-                quickstart.delete_g_task(taskID, 'inbox')
+                opqueue.submit('delete', 'inbox', task=taskID)
                 continue
             elif selection == 4:  # Project
                 self.d['projects'].i_new_item(key)
                 taskID = inbox.popleft()
-                quickstart.delete_g_task(taskID, 'inbox')
+                opqueue.submit('delete', 'inbox', task=taskID)
                 continue
             elif selection == 5:  # Maybe Someday
-                self.d['maybe_someday'].add(d[key]['title'], key)
+                self.d['maybe_someday'].add(d[key].title, key)
                 taskID = inbox.popleft()
-                quickstart.delete_g_task(taskID, 'inbox')
+                opqueue.submit('delete', 'inbox', task=taskID)
                 continue
             # elif 'r' in actionable:
             #     # TODO: add reference list
@@ -634,7 +816,7 @@ class GTD():
             #     continue
             elif selection == 6:  # Delete
                 taskID = inbox.popleft()
-                quickstart.delete_g_task(taskID, 'inbox')
+                opqueue.submit('delete', 'inbox', task=taskID)
                 print('Item deleted.')
                 continue
             elif selection == 7:  # Skip
@@ -655,7 +837,7 @@ class GTD():
             title = which.replace('_', ' ').title()
             print('\n', title)
             for i, item in enumerate(items):
-                print('  ' + str(i) + ' ' + item.text)
+                print('  ' + str(i) + ' ' + item.title)
             print(
                 'Enter number (if appropriate) followed by command [ie 1 d, 5t]:')
             print('(#d)one, (#t)rash, (#e)dit, (q)uit')
@@ -689,7 +871,7 @@ class GTD():
                 continue
 
             if command == 't':
-                print('Delete task: ' + items[index].text)
+                print('Delete task: ' + items[index].title)
                 confdelete = input('(y/n)').lower()
                 if 'y' in confdelete:
                     items.pop(index)
@@ -706,8 +888,13 @@ class GTD():
                 print('Not implimented')
                 continue
 
+    @timing.span('print_todosh', 'render')
     def print_todosh(self):
-        """Output as a todo.txt formatted text file."""
+        """Output as a todo.txt formatted text file.
+
+        The file is only rewritten if its content changed. Return True if it
+        was.
+        """
 
         # N = Next Action, P = Project, S = Someday/Maybe
         # Conveniently, they're in alphabetical order and won't interfere
@@ -720,43 +907,35 @@ class GTD():
         # there being no spaces. So the (P) task can be used as a description,
         # while +CamelCase notation can be used for a brief title that can
         # be used to group the project description and associated tasks.
-        with open(PARENT / 'pygtd.txt', 'w') as f:
-            for _, item in self.d['next_actions'].items.items():
-                text = '(N) ' + item.get('title')
-                text += '\n'
-                f.write(text)
-
-            for _, item in self.d['projects'].items.items():
-                text = '(P) ' + item.get('title')
-                text += '\n'
-                f.write(text)
-
-            for item in self.d['calendar'].items:
-                text = '(S) ' + item.get('summary')
-                date = item['start'].get('date')
-                if not date:
-                    date = item['start'].get('dateTime')
-                text = text + ' due:' + date
-                text += '\n'
-                f.write(text)
-
-            for _, item in self.d['waiting_for'].items.items():
-                text = '(W) ' + item.get('title')
-                due = item.get('due')
-                if due:
-                    text = text + ' due:' + due.strftime('%Y-%m-%d')
-                text += '\n'
-                f.write(text)
-
-            for _, item in self.d['maybe_someday'].items.items():
-                text = '(Z) ' + item.get('title')
-                text += '\n'
-                f.write(text)
-
-            for _, item in self.d['inbox'].items.items():
-                text = item.get('title')
-                text += '\n'
-                f.write(text)
+        from dateutil import parser
+        lines = []
+        for _, item in self.d['next_actions'].items.items():
+            lines.append('(N) ' + item.title)
+
+        for _, item in self.d['projects'].items.items():
+            lines.append('(P) ' + item.title)
+
+        for item in self.d['calendar'].items:
+            lines.append('(S) ' + item.summary + ' due:' + item.start)
+
+        for _, item in self.d['waiting_for'].items.items():
+            text = '(W) ' + item.title
+            due = item.due
+            if due:
+                # Google gives due dates as RFC 3339 strings.
+                if isinstance(due, str):
+                    due = parser.parse(due)
+                text = text + ' due:' + due.strftime('%Y-%m-%d')
+            lines.append(text)
+
+        for _, item in self.d['maybe_someday'].items.items():
+            lines.append('(Z) ' + item.title)
+
+        for _, item in self.d['inbox'].items.items():
+            lines.append(item.title)
+
+        content = ''.join(line + '\n' for line in lines).encode()
+        return write_if_changed(TODOSH_FILE, content)
 
 
 def main():
@@ -796,6 +975,13 @@ def main():
         help='Create Inbox prompt for task entry. For use with global keyboard '
         + 'shortcut.'
     )
+    group.add_argument(
+        '-s',
+        '--search',
+        nargs='+',
+        action='store',
+        help='Search all lists for tasks containing words starting with text.'
+    )
     group.add_argument(
         '-u',
         '--update-list',
@@ -812,8 +998,37 @@ def main():
         dest='process_inbox',
         help='Process Inbox items.'
     )
+    cache = parser.add_mutually_exclusive_group()
+    cache.add_argument(
+        '--refresh',
+        action='store_true',
+        help='Sync with Google before showing anything, even if local data '
+        + 'is recent.'
+    )
+    cache.add_argument(
+        '--offline',
+        action='store_true',
+        help='Only use data saved locally by the last sync.'
+    )
+    parser.add_argument(
+        '--profile',
+        action='store_true',
+        help='Print where the time went and save it as a Chrome trace. '
+        + '(Set PYGTD_PROFILE instead to include start-up.)'
+    )
     args = parser.parse_args()
 
+    if args.profile:
+        timing.enable()
+    # Registered before the queue's exit handler, so it runs after it and
+    # includes sending queued changes.
+    atexit.register(timing.dump)
+
+    # Changes to Google data are queued and sent in the background. Start
+    # sending anything left over from previous (ie offline) runs. Offline,
+    # exiting doesn't wait for them to be sent.
+    opqueue.start(flush_at_exit=not args.offline)
+
     # instantiate object responsible for data
     gtd = GTD()
     # Inbox now adds directly to Firebase before loading data to save time.
@@ -832,14 +1047,50 @@ def main():
         # show Inbox prompt. For use with global keyboard shortcut.
         gtd.d['inbox'].quickadd()
         return True
+    if args.search:  # -s, --search
+        gtd.search_tasks(' '.join(args.search))
+        return True
+
+    # load data. Use the local mirror if it was synced within CACHE_TTL (and
+    # nothing was changed since). Otherwise the overview shows it anyway while
+    # syncing in the background (and is printed again if anything changed).
+    # Commands that edit lists always sync first, once earlier changes have
+    # been sent, so they don't work on items that were already dealt with.
+    editing = args.update_list or args.process_inbox
+    age = gtd.cache_age()
+    refresh = None
+    if args.offline:
+        gtd.load_mirror()
+    elif args.refresh or editing or age is None or (age > CACHE_TTL
+                                                    and not args.overview):
+        if editing:
+            opqueue.flush()
+        print('Fetching data...')
+        gtd.fetch_all()
+    else:
+        gtd.load_mirror()
+        if age > CACHE_TTL:
+            fresh = GTD()
+
+            def revalidate():
+                try:
+                    fresh.fetch_all()
+                except Exception as e:
+                    print(f'Could not sync ({e}); showing saved data.')
+                    fresh.d = gtd.d
 
-    # load data
-    print('Fetching data...')
-    gtd.fetch_all()
+            refresh = threading.Thread(target=revalidate)
+            refresh.start()
 
     if args.overview:  # -o, --overview
         # print lists
         gtd.print_overview()
+        if refresh:
+            refresh.join()
+            if fresh.fingerprint() != gtd.fingerprint():
+                print('Updated from Google:\n')
+                fresh.print_overview()
+            gtd = fresh
     if args.update_list:
         s = args.update_list[0].lower()
         if s[0] == 'i':
@@ -875,7 +1126,5 @@ def main():
 if __name__ == '__main__':
     main()
 
-# TODO: if offline, save changes to by synced at next opportunity
-# Perhaps I could store operations in a queue...
 # TODO: write CRUD methods so if you change backend you only have to change
 # them in one place
@@ -0,0 +1,362 @@
+"""
+Durable queue of pending Google Tasks/Calendar changes for oopygtd.
+
+Every change is saved to a local SQLite file and submit() returns right away.
+A background thread sends queued changes to Google in batches, and anything it
+couldn't send (ie while offline) stays queued and is retried, including on the
+next run. Changes that cancel out, like adding a task and deleting it before
+it was ever sent, are dropped without touching the network.
+
+Operations:
+    insert   add task (body) to list. submit() returns a local ID for it,
+             which can be used in later operations on the same task.
+    delete   delete task from list
+    complete mark task in list as completed
+    event    add calendar event; body has 'summary' and ISO 'date_time'
+"""
+
+import atexit
+import datetime
+import fcntl
+import json
+import mirror
+import search
+import sqlite3
+import threading
+import timing
+import uuid
+from inspect import currentframe, getframeinfo
+from pathlib import Path
+
+FILENAME = getframeinfo(currentframe()).filename
+PARENT = Path(FILENAME).resolve().parent
+QUEUE_FILE = PARENT / 'opqueue.db'
+# Held while sending, so only one process sends the queue at a time.
+LOCK_FILE = PARENT / 'opqueue.lock'
+
+# Seconds between retries while there are unsent operations.
+RETRY_INTERVAL = 60
+# Max seconds to wait at exit for queued operations to be sent.
+FLUSH_TIMEOUT = 30
+# Times Google may reject an operation before it's set aside (parked) rather
+# than retried. It stays in the queue file, but isn't sent again.
+MAX_ATTEMPTS = 5
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS ops (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    op TEXT NOT NULL,
+    list TEXT,
+    task TEXT,
+    body TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS ids (
+    local TEXT PRIMARY KEY,
+    remote TEXT NOT NULL
+);
+'''
+
+wake = threading.Event()
+state = threading.Condition()
+worker_thread = None
+attempts = 0
+busy = False
+last_error = None
+
+
+def connect():
+    """Open queue database. Each thread needs its own connection."""
+    conn = sqlite3.connect(str(QUEUE_FILE), timeout=30)
+    conn.row_factory = sqlite3.Row
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.executescript(SCHEMA)
+    columns = [row['name'] for row in conn.execute('PRAGMA table_info(ops)')]
+    if 'attempts' not in columns:
+        # Queue file from before failed operations were counted.
+        conn.execute('ALTER TABLE ops '
+                     'ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0')
+    return conn
+
+
+@timing.span('opqueue.submit', 'storage')
+def submit(op, list=None, task=None, body=None):
+    """Queue an operation and return immediately.
+
+    For inserts, return the local ID assigned to the new task. Task changes
+    are searchable right away, see index_pending().
+    """
+    if op == 'insert':
+        task = 'local-' + uuid.uuid4().hex
+    conn = connect()
+    with conn:
+        conn.execute('INSERT INTO ops (op, list, task, body) '
+                     'VALUES (?, ?, ?, ?)',
+                     (op, list, task, json.dumps(body) if body else None))
+    conn.close()
+    if op != 'event':
+        index = search.connect()
+        with index:
+            apply_to_index(index, [{'op': op, 'list': list, 'task': task,
+                                    'body': body}])
+        index.close()
+    start()
+    wake.set()
+    return task
+
+
+def pending(conn):
+    """Return queued operations as a list of dicts, oldest first.
+
+    Parked operations are left out.
+    """
+    ops = []
+    for row in conn.execute('SELECT * FROM ops WHERE attempts < ? '
+                            'ORDER BY id', (MAX_ATTEMPTS,)):
+        op = dict(row)
+        op['body'] = json.loads(op['body']) if op['body'] else None
+        ops.append(op)
+    return ops
+
+
+def apply_to_index(index, ops, remote=None):
+    """Make search index show tasks as they'll be once ops are sent.
+
+    remote maps local IDs of tasks that have been added to their IDs.
+    """
+    remote = remote or {}
+    for op in ops:
+        task = remote.get(op['task'], op['task'])
+        if op['op'] == 'insert':
+            search.add(index, 'google', op['list'], task, op['body'])
+        elif op['op'] in ('delete', 'complete'):
+            # Completed tasks aren't searched either.
+            search.remove(index, 'google', op['list'], task)
+
+
+def index_pending(index):
+    """Apply all queued task operations to search index.
+
+    The mirror's index only has tasks as last synced, and rebuilding it or
+    syncing a whole list drops changes that haven't been sent yet, so this
+    is needed before searching as well as when they're submitted.
+    """
+    conn = connect()
+    ops = pending(conn)
+    remote = {row['local']: row['remote']
+              for row in conn.execute('SELECT * FROM ids')}
+    conn.close()
+    with index:
+        apply_to_index(index, ops, remote)
+
+
+def coalesce(ops):
+    """Combine operations that cancel out or repeat each other.
+
+    Return (ops to send, IDs of ops that no longer need sending). Inserts
+    that a later complete was folded into have their body changed, so it has
+    to be saved along with dropping the complete.
+    """
+    send = []
+    dropped = []
+    inserts = {}  # unsent inserts by local task ID
+    latest = {}  # last delete/complete by (list, task)
+    for op in ops:
+        if op['op'] == 'insert':
+            inserts[op['task']] = op
+        elif op['op'] in ('delete', 'complete') and op['task'] in inserts:
+            # Task hasn't been created yet, so just change what's created.
+            insert = inserts[op['task']]
+            if op['op'] == 'delete':
+                send.remove(insert)
+                dropped.append(insert['id'])
+                del inserts[op['task']]
+            else:
+                insert['body']['status'] = 'completed'
+            dropped.append(op['id'])
+            continue
+        elif op['op'] in ('delete', 'complete'):
+            key = (op['list'], op['task'])
+            previous = latest.get(key)
+            if previous and previous['op'] == 'delete':
+                dropped.append(op['id'])
+                continue
+            if previous:
+                # Deleting (or completing again) supersedes completing.
+                send.remove(previous)
+                dropped.append(previous['id'])
+            latest[key] = op
+        send.append(op)
+    return send, dropped
+
+
+def gone(error):
+    """Return True if error means the task no longer exists."""
+    status = getattr(getattr(error, 'resp', None), 'status', None)
+    return status in (404, 410)
+
+
+@timing.span('opqueue.drain', 'network')
+def drain():
+    """Send all queued operations. Return number of operations sent.
+
+    Operations that fail stay in the queue, until they've been rejected
+    MAX_ATTEMPTS times. Raises if Google can't be reached at all. Waits for
+    any other process that is sending the queue to finish first.
+    """
+    # Imported here so queuing a change doesn't pay for API setup.
+    import quickstart
+
+    lock = open(LOCK_FILE, 'a')
+    conn = connect()
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        send, dropped = coalesce(pending(conn))
+        # Save what was combined before sending anything, so a failed send
+        # is retried with the combined operations.
+        with conn:
+            conn.executemany('UPDATE ops SET body = ? WHERE id = ?',
+                             [(json.dumps(op['body']), op['id'])
+                              for op in send if op['op'] == 'insert'])
+            conn.executemany('DELETE FROM ops WHERE id = ?',
+                             [(i,) for i in dropped])
+        remote = {row['local']: row['remote']
+                  for row in conn.execute('SELECT * FROM ids')}
+        tasks = [op for op in send if op['op'] != 'event']
+        events = [op for op in send if op['op'] == 'event']
+        batch = None
+        ids = []
+        done = []
+        failed = []
+        try:
+            if tasks:
+                batch = quickstart.TaskBatch()
+                for op in tasks:
+                    if op['op'] == 'insert':
+                        batch.insert(op['body'], op['list'])
+                    else:
+                        task = remote.get(op['task'], op['task'])
+                        getattr(batch, op['op'])(task, op['list'])
+                batch.flush()
+            for op in events:
+                when = datetime.datetime.fromisoformat(op['body']['date_time'])
+                quickstart.save_event(op['body']['summary'], when)
+                done.append(op['id'])
+        finally:
+            # Record whatever was sent, even if a later round trip failed, so
+            # only unsent operations are tried again.
+            for op, result in zip(tasks, batch.results if batch else []):
+                error = result['error']
+                if error is None and op['op'] == 'insert':
+                    ids.append((op['task'], result['response']['id']))
+                if error is None or (op['op'] != 'insert' and gone(error)):
+                    done.append(op['id'])
+                else:
+                    failed.append(op['id'])
+            if ids:
+                # Indexed under their local IDs when submitted.
+                lists = {op['task']: op['list'] for op in tasks}
+                index = search.connect()
+                with index:
+                    for local, remote_id in ids:
+                        search.rename(index, 'google', lists[local], local,
+                                      remote_id)
+                index.close()
+            with conn:
+                conn.executemany('INSERT OR REPLACE INTO ids VALUES (?, ?)',
+                                 ids)
+                conn.executemany('DELETE FROM ops WHERE id = ?',
+                                 [(i,) for i in done])
+                conn.executemany('UPDATE ops SET attempts = attempts + 1 '
+                                 'WHERE id = ?', [(i,) for i in failed])
+            mark_changed(tasks + events, set(done))
+        return len(send)
+    finally:
+        conn.close()
+        lock.close()
+
+
+def mark_changed(ops, done):
+    """Mark lists changed by sent operations as out of date in mirror.
+
+    The mirror doesn't see these changes until it's synced, so this makes
+    the next oopygtd run sync rather than show the saved lists as current.
+    """
+    keys = {'events_synced' if op['op'] == 'event'
+            else 'tasks_synced:' + op['list']
+            for op in ops if op['id'] in done}
+    if not keys:
+        return
+    conn = mirror.connect()
+    with conn:
+        for key in keys:
+            mirror.mark_changed(conn, key)
+    conn.close()
+
+
+def count(parked=False):
+    """Return number of queued operations, or of parked ones."""
+    conn = connect()
+    n = conn.execute('SELECT COUNT(*) FROM ops WHERE (attempts >= ?) = ?',
+                     (MAX_ATTEMPTS, parked)).fetchone()[0]
+    conn.close()
+    return n
+
+
+def worker():
+    """Send queued operations whenever woken, and retry periodically."""
+    global attempts, busy, last_error
+    while True:
+        wake.wait(RETRY_INTERVAL)
+        wake.clear()
+        with state:
+            busy = True
+        try:
+            drain()
+            error = None
+        except Exception as e:  # offline, auth failure, etc: retry later
+            error = e
+        with state:
+            busy = False
+            last_error = error
+            attempts += 1
+            state.notify_all()
+
+
+def start(flush_at_exit=True):
+    """Start background sender if it isn't running yet.
+
+    Unless flush_at_exit is False (ie offline), exiting waits for queued
+    operations to be sent, see flush().
+    """
+    global worker_thread
+    if worker_thread is None:
+        worker_thread = threading.Thread(target=worker, daemon=True)
+        worker_thread.start()
+        wake.set()  # send anything left over from previous runs
+        if flush_at_exit:
+            atexit.register(flush)
+
+
+@timing.span('opqueue.flush')
+def flush(timeout=FLUSH_TIMEOUT):
+    """Wait (up to timeout seconds) for one attempt to send the queue.
+
+    Return number of operations still queued.
+    """
+    start()
+    with state:
+        # An attempt already under way may have missed the newest operations.
+        target = attempts + (2 if busy else 1)
+        wake.set()
+        state.wait_for(lambda: attempts >= target, timeout)
+        error = last_error
+    left = count()
+    if left:
+        print(f'{left} change(s) not yet sent to Google ({error}). '
+              'They will be retried next time.')
+    parked = count(parked=True)
+    if parked:
+        print(f'{parked} change(s) were rejected by Google {MAX_ATTEMPTS} '
+              f'times and won\'t be retried. They are kept in {QUEUE_FILE}.')
+    return left
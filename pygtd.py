@@ -3,13 +3,18 @@
 """This is now the rough draft/proof-of-concept."""
 
 import argparse
+import capture
 import json
+import journal
+import search
+import sqlite_store
 import pyperclip
 import datetime
 import re
-from os import path
+import shutil
+from itertools import chain, islice
+from os import path, environ
 from time import time, sleep
-from sys import stdout, argv, exit
 from dateutil import parser
 from inspect import currentframe, getframeinfo
 from pathlib import Path
@@ -27,8 +32,42 @@ process inbox
 FILENAME = getframeinfo(currentframe()).filename
 PARENT = Path(FILENAME).resolve().parent
 DATA_FILE = PARENT / 'pygtd.json'
+SNAPSHOT_DIR = PARENT / 'pygtd.d'
+JOURNAL_FILE = PARENT / 'pygtd.journal'
+DB_FILE = PARENT / 'data.db'
 
-data = {
+# 'journal' (per-container snapshots plus append-only journal) or 'sqlite'.
+STORAGE = environ.get('PYGTD_STORAGE', 'journal')
+
+# Number of journal records after which load_data() folds the journal into a
+# fresh snapshot.
+COMPACT_AFTER = 500
+
+
+class Containers(dict):
+    """Dict of GTD containers (inbox, actions, etc).
+
+    If given a loader, a container is only loaded when first accessed, by
+    calling loader with its name. Without one, missing containers start empty.
+    """
+
+    def __init__(self, contents=(), loader=None):
+        super().__init__(contents)
+        self.loader = loader
+
+    def __missing__(self, container):
+        items = dict(self.loader(container)) if self.loader else {}
+        self[container] = items
+        return items
+
+    def cached(self, container):
+        """Return container if it's in memory (or can be created empty)."""
+        if container in self or self.loader is None:
+            return self[container]
+        return None
+
+
+data = Containers({
     'inbox': {},
     'actions': {},
     'projects': {},
@@ -36,7 +75,9 @@ data = {
     'waiting_for': {},
     'scheduled': {},
     'reference': {}
-}
+})
+db = None
+index = None
 
 # add to inbox from cli
 # add to inbox from clipboard
@@ -44,21 +85,254 @@ data = {
 # list
 
 
+def search_index():
+    """Return connection to search index, opening it on first use."""
+    global index
+    if index is None:
+        index = search.connect()
+    return index
+
+
 def load_data():
-    """Retrieve data from JSON file."""
-    global data
-    if not path.isfile(DATA_FILE):
-        with open(DATA_FILE, 'w') as file:
-            json.dump(data, file)
+    """Open data store.
+
+    Containers aren't read until first accessed, so a command only pays for
+    the ones it uses.
+    """
+    global data, db
+    if STORAGE == 'sqlite':
+        db = sqlite_store.connect(DB_FILE)
+        if not sqlite_store.count(db) and (path.isdir(SNAPSHOT_DIR)
+                                           or path.isfile(DATA_FILE)):
+            # First run with SQLite: carry over existing JSON data.
+            load_json()
+            sqlite_store.save(db, {c: data[c] for c in json_containers()})
+        data = Containers(loader=lambda c: sqlite_store.items(db, c))
     else:
-        with open(DATA_FILE, 'r') as file:
-            data = json.load(file)
+        load_json()
+    # Pick up anything captured by quick_add.py since the last run.
+    capture.drain(lambda items: put_many('inbox', items))
+
+
+def load_json():
+    """Open snapshot directory and journal.
+
+    Each container is read from its own snapshot file, with its journal
+    records replayed on top, when first accessed.
+    """
+    global data
+    if not path.isdir(SNAPSHOT_DIR):
+        migrate_json()
+    data = Containers(loader=load_container)
+    if STORAGE != 'sqlite' and journal.length(JOURNAL_FILE) >= COMPACT_AFTER:
+        save_data()
+
+
+def load_container(container):
+    """Read container from snapshot file and replay its journal records."""
+    items = dict(journal.read_container(SNAPSHOT_DIR / (container + '.jsonl')))
+    journal.replay(JOURNAL_FILE, {container: items}, container)
+    return items
+
+
+def stored_containers():
+    """Return names of all containers that have been stored."""
+    if STORAGE == 'sqlite':
+        return sqlite_store.containers(db)
+    return json_containers()
+
+
+def json_containers():
+    """Return names of all containers in snapshot directory or journal."""
+    names = {p.stem for p in SNAPSHOT_DIR.glob('*.jsonl')}
+    return names | journal.containers(JOURNAL_FILE)
+
+
+def migrate_json():
+    """Split single-file pygtd.json into per-container snapshot files.
+
+    The snapshots are written to a temporary directory which is then renamed
+    into place, so an interrupted migration is simply run again.
+    """
+    tmp = SNAPSHOT_DIR.with_suffix('.d.tmp')
+    with journal.locked(JOURNAL_FILE) as f:
+        if path.isdir(SNAPSHOT_DIR):
+            # Another process migrated while we waited for the lock.
+            return
+        shutil.rmtree(tmp, ignore_errors=True)
+        tmp.mkdir()
+        old = {}
+        if path.isfile(DATA_FILE):
+            with open(DATA_FILE, 'r') as file:
+                old = json.load(file)
+        journal.replay(JOURNAL_FILE, old)
+        for container, items in old.items():
+            journal.write_container(tmp / (container + '.jsonl'), items)
+        tmp.rename(SNAPSHOT_DIR)
+        # Only now the journal is folded into the snapshots in place.
+        journal.compact(SNAPSHOT_DIR, f, {})
+    if path.isfile(DATA_FILE):
+        DATA_FILE.rename(DATA_FILE.with_suffix('.json.bak'))
 
 
 def save_data():
-    """Save data to json file."""
-    with open(DATA_FILE, 'w') as file:
-        json.dump(data, file)
+    """Save all loaded data.
+
+    Rewrites whole containers, so it's only used for compaction. Individual
+    changes should go through put(), remove() and clear() instead.
+
+    With the journal, containers are read back from storage while holding the
+    journal lock, rather than saved from memory, so changes written by other
+    processes are kept.
+    """
+    if STORAGE == 'sqlite':
+        sqlite_store.save(db, data)
+    else:
+        with journal.locked(JOURNAL_FILE) as f:
+            fresh = {c: load_container(c)
+                     for c in journal.containers(JOURNAL_FILE)}
+            conn = search_index()
+            if search.built(conn, 'pygtd'):
+                # Index the journal before it's gone, and start over at the
+                # beginning of the now empty journal.
+                update_index(conn, f)
+                with conn:
+                    search.set_position(conn, 'pygtd', 0)
+            journal.compact(SNAPSHOT_DIR, f, fresh)
+        data.update(fresh)
+
+
+def put(container, key, value):
+    """Set item in container and write the change to storage."""
+    key = str(key)
+    items = data.cached(container)
+    if items is not None:
+        items[key] = value
+    if STORAGE == 'sqlite':
+        sqlite_store.put(db, container, key, value)
+    else:
+        journal.append(JOURNAL_FILE,
+                       {'op': 'put', 'c': container, 'k': key, 'v': value})
+
+
+def remove(container, key):
+    """Delete item from container and write the change to storage."""
+    key = str(key)
+    items = data.cached(container)
+    if items is not None:
+        del items[key]
+    if STORAGE == 'sqlite':
+        sqlite_store.delete(db, container, key)
+    else:
+        journal.append(JOURNAL_FILE, {'op': 'del', 'c': container, 'k': key})
+
+
+def put_many(container, pairs, sync_every=None):
+    """Set (key, value) pairs from an iterable, committing in chunks.
+
+    Pairs are streamed to storage and committed every sync_every items (or
+    all at once at the end). If interrupted, chunks already committed are kept
+    and the rest isn't stored. Return number of items written.
+    """
+    items = data.cached(container)
+    pairs = iter(pairs)
+
+    def cache(pairs):
+        for key, value in pairs:
+            if items is not None:
+                items[key] = value
+            yield key, value
+
+    count = 0
+    for first in pairs:
+        chunk = cache(chain([first], islice(
+            pairs, sync_every - 1 if sync_every else None)))
+        if STORAGE == 'sqlite':
+            count += sqlite_store.put_many(db, container, chunk)
+        else:
+            count += journal.extend(JOURNAL_FILE, (
+                {'op': 'put', 'c': container, 'k': key, 'v': value}
+                for key, value in chunk))
+    return count
+
+
+def clear(container):
+    """Delete all items from container and write the change to storage."""
+    data[container] = {}
+    if STORAGE == 'sqlite':
+        sqlite_store.clear(db, container)
+    else:
+        journal.append(JOURNAL_FILE, {'op': 'clear', 'c': container})
+
+
+def stored_items(container):
+    """Return items of container as stored, ignoring what's in memory."""
+    if STORAGE == 'sqlite':
+        return dict(sqlite_store.items(db, container))
+    return load_container(container)
+
+
+def update_index(conn, journal_file=None):
+    """Index changes stored since the search index was last updated.
+
+    Changes aren't indexed as they're made, which would make every write pay
+    for a second transaction, but in one go when the index is next needed.
+    The index position is the sequence number of the last change logged by
+    sqlite_store, or the journal offset indexed up to. With the journal,
+    journal_file is the journal as opened by journal.locked(), which must be
+    held.
+    """
+    start = search.position(conn, 'pygtd')
+    if STORAGE == 'sqlite':
+        end = sqlite_store.last_change(db)
+    else:
+        end = journal_file.tell()
+    with conn:
+        if not search.built(conn, 'pygtd') or start > end:
+            # Index data saved before there was one (or since lost track of).
+            search.build(conn, 'pygtd', (
+                (container, key, value) for container in stored_containers()
+                for key, value in stored_items(container).items()))
+        elif STORAGE == 'sqlite':
+            for container, key in sqlite_store.changes(db, start, end):
+                if key is None:
+                    search.clear(conn, 'pygtd', container)
+                    for key, value in sqlite_store.items(db, container):
+                        search.add(conn, 'pygtd', container, key, value)
+                    continue
+                value = sqlite_store.get(db, container, key)
+                if value is None:
+                    search.remove(conn, 'pygtd', container, key)
+                else:
+                    search.add(conn, 'pygtd', container, key, value)
+        else:
+            for record in journal.records(JOURNAL_FILE, start=start):
+                if record['op'] == 'put':
+                    search.add(conn, 'pygtd', record['c'], record['k'],
+                               record['v'])
+                elif record['op'] == 'del':
+                    search.remove(conn, 'pygtd', record['c'], record['k'])
+                elif record['op'] == 'clear':
+                    search.clear(conn, 'pygtd', record['c'])
+        search.set_position(conn, 'pygtd', end)
+    if STORAGE == 'sqlite':
+        sqlite_store.forget_changes(db, end)
+
+
+def search_items(text):
+    """Print items in any container matching text, best matches first."""
+    conn = search_index()
+    if STORAGE == 'sqlite':
+        update_index(conn)
+    else:
+        with journal.locked(JOURNAL_FILE) as f:
+            update_index(conn, f)
+    results = search.query(conn, 'pygtd', text)
+    for container, _, item in results:
+        print('[{}] {}'.format(container, item))
+    if not results:
+        print('No items match "{}".'.format(text))
+    return results
 
 
 def days_remaining(date_string):
@@ -68,18 +342,37 @@ def days_remaining(date_string):
 
 
 def add_to_inbox(text):
-    global data
     time_stamp = time()
-    data['inbox'][time_stamp] = text
-    save_data()
+    put('inbox', time_stamp, text)
     print('Item added to inbox: {}'.format(text))
 
 
-def file_to_inbox():
-    """Add each line of a plain text file as a new Inbox item."""
-    with open(argv[1], 'r') as f:
-        for line in f:
-            add_to_inbox(line)
+def file_to_inbox(filename, sync_every=None):
+    """Add each line of a plain text file as a new Inbox item.
+
+    The file is streamed line by line straight into storage, which is
+    committed once at the end (or every sync_every lines), instead of saving
+    after each item. An interrupted import keeps only what was committed.
+    Blank lines are skipped.
+    """
+    start = time()
+
+    def lines():
+        with open(filename, 'r') as f:
+            for n, line in enumerate(f):
+                text = line.rstrip('\n')
+                if not text.strip():
+                    continue
+                # Lines are read faster than time() ticks, so space keys a
+                # microsecond apart to keep them unique and in file order.
+                yield str(start + n / 1e6), text
+
+    count = put_many('inbox', lines(), sync_every)
+    elapsed = time() - start
+    rate = count / elapsed if elapsed else count
+    print('Imported {} items to inbox in {:.2f} seconds ({:.0f} items/s).'
+          .format(count, elapsed, rate))
+    return count
 
 
 def empty(container):
@@ -88,8 +381,7 @@ def empty(container):
     confirmation = input("Are you sure? (y/n): ")
     if 'y' in confirmation:
         if data[container]:
-            data[container] = {}
-            save_data()
+            clear(container)
         else:
             print("{} is already empty.".format(container))
     else:
@@ -121,13 +413,8 @@ def timer(seconds):
     # TODO: add alarm sound
 
 
-timer(10)
-exit()
-
-
 def delete_from_inbox(id, container='inbox'):
-    del data[container][id]
-    save_data()
+    remove(container, id)
     print('Item removed from ' + container + '.')
     return True
 
@@ -135,25 +422,18 @@ def delete_from_inbox(id, container='inbox'):
 def complete(id, container='actions'):
     dt = datetime.datetime.now().strftime("%A, %d. %B %Y %I:%M%p")
     text = data[container][id]
-    try:
-        data['completed'][id] = {'completion_date': dt, 'text': text}
-    except KeyError:
-        data['completed'] = {}
-        data['completed'][id] = {'completion_date': dt, 'text': text}
-
+    put('completed', id, {'completion_date': dt, 'text': text})
     delete_from_inbox(id, container)
     return True
 
 
 def new_action(id):
-    global data
     print("Next Action: What's the next thing you need to do to move toward "
           + "the desired outcome?\nVisualize yourself doing it and describe it "
           + "in a sentence. Be specific. Ie not 'set up meeting', but 'pick up "
           + "the phone and call X'.")
     text = input("> ")
-    data['actions'][id] = text
-    save_data()
+    put('actions', id, text)
     print('Item added to Next Actions list.')
 
 
@@ -167,8 +447,7 @@ def new_appointment(id=time()):
         isok = input("Ok? (y/n)").lower()
         if 'y' in isok:
             ok = True
-    data['scheduled'][id] = {'date': when, 'text': text}
-    save_data()
+    put('scheduled', id, {'date': when, 'text': text})
     print('Appointment added to Scheduled list.')
 
 
@@ -177,8 +456,7 @@ def new_project(id=time()):
                  + "to accomplishing or finishing about this? What would 'done'"
                  + " look like?\n> ")
     short_name = input("Short name: ")
-    data['projects'][id] = {'short_name': short_name, 'text': text}
-    save_data()
+    put('projects', id, {'short_name': short_name, 'text': text})
 
 
 def process_inbox_item(num, total, id):
@@ -204,35 +482,23 @@ def process_inbox_item(num, total, id):
         done = input("Done? (y/n): ").lower()
         if 'y' in done:
             delete_from_inbox(id)
-            save_data()
         else:
             process_inbox_item(num, total, id)
     elif 'c' in actionable:
         new_appointment(id)
         delete_from_inbox(id)
     elif 'w' in actionable:
-        try:
-            data['waiting'][id] = data['inbox'][id]
-            delete_from_inbox(id)
-        except KeyError:
-            data['waiting'] = {}
-            data['waiting'][id] = data['inbox'][id]
-            delete_from_inbox(id)
+        put('waiting', id, data['inbox'][id])
+        delete_from_inbox(id)
     elif 'p' in actionable:
         new_project(id)
     elif 's' in actionable:
-        data['someday_maybe'][id] = data['inbox'][id]
+        put('someday_maybe', id, data['inbox'][id])
         delete_from_inbox(id)
-        save_data()
         print('Item added to Someday/Maybe list.')
     elif 'r' in actionable:
-        try:
-            data['reference'][id] = data['inbox'][id]
-            delete_from_inbox(id)
-        except KeyError:
-            data['reference'] = {}
-            data['reference'][id] = data['inbox'][id]
-            delete_from_inbox(id)
+        put('reference', id, data['inbox'][id])
+        delete_from_inbox(id)
         print('Item added to Reference list.')
     elif 't' in actionable:
         delete_from_inbox(id)
@@ -300,7 +566,7 @@ def process_projects():
             id = time()
             new_action(id)
             data['projects'][project]['next_actions'].append(str(id))
-            save_data()
+            put('projects', project, data['projects'][project])
     print('\nDone processing projects!\n')
 
 
@@ -412,6 +678,21 @@ def main():
         action='store_true',
         help='Add each line in plain text file as new Inbox item.'
     )
+    parser.add_argument(
+        '-s',
+        '--search',
+        action='store_true',
+        help='Search all lists for items containing words starting with text.'
+    )
+    parser.add_argument(
+        '--sync-every',
+        dest='sync_every',
+        type=int,
+        metavar='N',
+        help='With -f, commit imported items every N lines, so an '
+        + 'interrupted import keeps what was committed. (By default it '
+        + 'keeps nothing.)'
+    )
 
     args = parser.parse_args()
     text = ' '.join(args.input) if args.input else pyperclip.paste()
@@ -435,8 +716,11 @@ def main():
     elif args.process_projects:
         process_projects()
 
+    if args.search:
+        search_items(' '.join(args.input))
+
     if args.import_file:
-        file_to_inbox()
+        file_to_inbox(args.input[0], args.sync_every)
 
 
 if __name__ == '__main__':
@@ -4,26 +4,25 @@
 Open terminal window with prompt to quickly enter text to save in Inbox. Best
 used with global keyboard shortcut. Alternatively, if called with -c, will add
 contents of clipboard to Inbox.
-"""
 
-# TODO: Fix pylint error: unable to import pygtd (but it works anyway...)
+Only capture is imported, so the prompt shows up as fast as possible. Items
+are merged into the Inbox the next time pygtd.py runs.
+"""
 
-import argparse
-import pyperclip
-from pygtd import load_data, save_data, add_to_inbox, inbox_popup
-from os import path
-from time import time
 from sys import argv
 
-data = {}
+import capture
 
 
 def main():
-    load_data()
-    if argv[1] == '-c':
-        add_to_inbox(pyperclip.paste())
+    if len(argv) > 1 and argv[1] == '-c':
+        import pyperclip
+        text = pyperclip.paste()
     else:
-        inbox_popup()
+        text = input('INBOX> ')
+    if text.strip():
+        capture.capture(text)
+        print('Item added to inbox: {}'.format(text))
 
 
 if __name__ == '__main__':
@@ -25,13 +25,14 @@ service object and outputs a list of the next 10 events on the user's calendar.
 # Dev console for tasks api:
 # https://console.developers.google.com/apis/api/tasks.googleapis.com/overview?project=pygtd-b8b3d&duration=PT1H
 from __future__ import print_function
-from apiclient.discovery import build
-from httplib2 import Http
-from oauth2client import file, client, tools
 import datetime
+import hashlib
+import itertools
 import json
+import os
+import threading
 import time
-from dateutil import parser
+import timing
 from inspect import currentframe, getframeinfo
 from pathlib import Path
 
@@ -41,18 +42,148 @@ PARENT = Path(FILENAME).resolve().parent
 CREDENTIALS = PARENT / 'credentials.json'
 CLIENT_SECRET = PARENT / 'client_secret.json'
 LIST_IDS_FILE = PARENT / 'g_list_ids.json'
+DISCOVERY_CACHE_DIR = PARENT / '.discovery_cache'
+# Seconds before a cached API discovery document is fetched again.
+DISCOVERY_CACHE_TTL = 24 * 60 * 60
+# Max number of sub-requests sent in one HTTP batch request.
+BATCH_SIZE = 50
+# Items requested per page when listing tasks and events. (The APIs allow up to
+# 100 tasks and 2500 events per page.)
+TASKS_PAGE_SIZE = 100
+EVENTS_PAGE_SIZE = 250
 SCOPES = ['https://www.googleapis.com/auth/tasks',
           'https://www.googleapis.com/auth/calendar']
+# Base URL of a stand-in for the Google APIs, ie benchmarks/fake_google.py. If
+# set, requests go there instead, without authorization, and list IDs are
+# looked up from it.
+API_URL = os.environ.get('PYGTD_GOOGLE_API')
 
-# Set up Google API
-store = file.Storage(CREDENTIALS)
-creds = store.get()
-if not creds or creds.invalid:
-    flow = client.flow_from_clientsecrets(CLIENT_SECRET, SCOPES)
-    creds = tools.run_flow(flow, store)
+# Google API credentials, loaded by get_credentials() when first needed.
+creds = None
+creds_lock = threading.Lock()
 
-with open(LIST_IDS_FILE, 'r') as f:
-    LIST_IDS = json.load(f)
+
+def get_credentials():
+    """Return Google API credentials, authorizing the app if needed.
+
+    Loading them (and the Google client libraries) is put off until a request
+    is made, so commands that don't talk to Google start quickly.
+    """
+    global creds
+    with creds_lock:
+        if creds is None:
+            from oauth2client import file, client, tools
+            with timing.span('google auth', 'network'):
+                store = file.Storage(CREDENTIALS)
+                creds = store.get()
+                if not creds or creds.invalid:
+                    flow = client.flow_from_clientsecrets(CLIENT_SECRET,
+                                                          SCOPES)
+                    creds = tools.run_flow(flow, store)
+    return creds
+
+
+class ListIDs(dict):
+    """Task list IDs by list name, ie LIST_IDS['inbox'].
+
+    They're read from g_list_ids.json (or looked up from API_URL) the first
+    time one is needed.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.loaded = False
+        self.lock = threading.Lock()
+
+    def __missing__(self, name):
+        with self.lock:
+            if not self.loaded:
+                if API_URL:
+                    self.update(fetch_list_ids())
+                else:
+                    with open(LIST_IDS_FILE, 'r') as f:
+                        self.update(json.load(f))
+                self.loaded = True
+        if name in self:
+            return self[name]
+        raise KeyError(name)
+
+
+LIST_IDS = ListIDs()
+
+
+class DiscoveryCache():
+    """Keep API discovery documents on disk between runs.
+
+    Implements the get/set interface build() expects from its cache argument.
+
+    """
+
+    def __init__(self, directory=DISCOVERY_CACHE_DIR,
+                 ttl=DISCOVERY_CACHE_TTL):
+        self.directory = Path(directory)
+        self.ttl = ttl
+
+    def path(self, url):
+        return self.directory / (hashlib.sha1(url.encode()).hexdigest()
+                                 + '.json')
+
+    def get(self, url):
+        path = self.path(url)
+        try:
+            if time.time() - path.stat().st_mtime > self.ttl:
+                return None
+            return path.read_text()
+        except OSError:
+            return None
+
+    def set(self, url, content):
+        path = self.path(url)
+        try:
+            self.directory.mkdir(exist_ok=True)
+            tmp = path.with_suffix('.tmp')
+            tmp.write_text(content)
+            os.replace(tmp, path)
+        except OSError:
+            pass
+
+
+# API clients and the authorized connection they share, so each is only set
+# up once. httplib2 connections can't be used from several threads at once, so
+# each thread gets its own. Use get_service() rather than calling build().
+local = threading.local()
+discovery_cache = DiscoveryCache()
+
+
+def get_service(name, version):
+    """Return Google API client, building it the first time it's needed.
+
+    All clients in a thread share one authorized keep-alive HTTP connection,
+    and discovery documents are cached on disk so build() doesn't fetch them
+    every run.
+    """
+    from googleapiclient.discovery import build
+    from httplib2 import Http
+    if not hasattr(local, 'services'):
+        local.services = {}
+        local.http = Http() if API_URL else get_credentials().authorize(Http())
+    key = (name, version)
+    if key not in local.services:
+        options = {}
+        if API_URL:
+            options['discoveryServiceUrl'] = (
+                API_URL + '/discovery/v1/apis/{api}/{apiVersion}/rest')
+        with timing.span('build', 'network', api=name):
+            local.services[key] = build(name, version, http=local.http,
+                                        cache=discovery_cache, **options)
+    return local.services[key]
+
+
+def execute(request):
+    """Send API request and return response, timing it."""
+    with timing.span(getattr(request, 'methodId', None) or 'request',
+                     'network'):
+        return request.execute()
 
 
 def tz_offset():
@@ -78,20 +209,67 @@ def pythonize(s):
     return s.lower().replace(' ', '_')
 
 
+def iter_pages(collection, request):
+    """Yield items from every page of a list request, fetching as needed.
+
+    collection is the resource the request came from, ie service.tasks().
+    """
+    while request is not None:
+        response = execute(request)
+        yield from response.get('items', [])
+        request = collection.list_next(request, response)
+
+
+def iter_events(days=None, page_size=EVENTS_PAGE_SIZE):
+    """Yield future events from Google Calendar API in order of start time.
+
+    If days is given, only events starting within that many days are
+    returned. Pages are fetched as the generator is consumed.
+    """
+
+    events = get_service('calendar', 'v3').events()
+    now = datetime.datetime.utcnow()
+    params = {'timeMin': now.isoformat() + 'Z'}  # 'Z' = UTC time
+    if days is not None:
+        time_max = now + datetime.timedelta(days=days)
+        params['timeMax'] = time_max.isoformat() + 'Z'
+    request = events.list(calendarId='primary', maxResults=page_size,
+                          singleEvents=True, orderBy='startTime', **params)
+    yield from iter_pages(events, request)
+
+
+def sync_events(sync_token=None, page_size=EVENTS_PAGE_SIZE):
+    """Return (events, next sync token) from Google Calendar API.
+
+    Without sync_token, return all future events. With one, return only
+    events changed since the sync that returned it; deleted events have status
+    'cancelled'. Raises HttpError with status 410 if the token has expired.
+    """
+
+    events = get_service('calendar', 'v3').events()
+    if sync_token:
+        params = {'syncToken': sync_token}
+    else:
+        params = {'timeMin': datetime.datetime.utcnow().isoformat() + 'Z'}
+    request = events.list(calendarId='primary', maxResults=page_size,
+                          singleEvents=True, **params)
+    items = []
+    while request is not None:
+        response = execute(request)
+        items.extend(response.get('items', []))
+        next_token = response.get('nextSyncToken')
+        request = events.list_next(request, response)
+    return items, next_token
+
+
 def get_events(num):
     """Get events from Google Calendar API.
 
     Returns num number of future events as a list of dictionaries.
     """
 
-    service = build('calendar', 'v3', http=creds.authorize(Http()))
-
-    # Call the Calendar API
-    now = datetime.datetime.utcnow().isoformat() + 'Z'  # 'Z' = UTC time
-    events_result = service.events().list(calendarId='primary', timeMin=now,
-                                          maxResults=num, singleEvents=True,
-                                          orderBy='startTime').execute()
-    events = events_result.get('items', [])
+    events = list(itertools.islice(iter_events(page_size=min(
+        num, EVENTS_PAGE_SIZE)), num))
 
     with open(PARENT / 'gcal_test.json', 'w') as f:
         json.dump(events, f)
@@ -110,7 +288,7 @@ def save_event(summary, date_time):
     hour event will be assumed.
     """
 
-    cal = build('calendar', 'v3', http=creds.authorize(Http()))
+    cal = get_service('calendar', 'v3')
 
     event = {
         'summary': summary,
@@ -128,24 +306,53 @@ def save_event(summary, date_time):
         event['end'].update({'dateTime': end.isoformat()})
 
     # Create event with Google Calendar API
-    e = cal.events().insert(calendarId='primary',
-                            sendNotifications=True, body=event).execute()
+    e = execute(cal.events().insert(calendarId='primary',
+                                    sendNotifications=True, body=event))
     return e
 
 
-def fetch_g_tasks(bucket):
-    """Fetch uncompleted tasks from Google API & return as list of dicts.
+def iter_g_tasks(bucket, page_size=TASKS_PAGE_SIZE):
+    """Yield uncompleted tasks in list from Google API, one page at a time.
 
     Takes list name as input which is matched with list ID using json file
     to retrieve tasks for that list.
     """
 
+    tasks = get_service('tasks', 'v1').tasks()
+    request = tasks.list(tasklist=LIST_IDS[bucket], showCompleted=False,
+                         maxResults=page_size)
+    yield from iter_pages(tasks, request)
+
+
+def iter_g_task_changes(bucket, updated_min, page_size=TASKS_PAGE_SIZE):
+    """Yield tasks in list changed since updated_min (RFC 3339 timestamp).
+
+    Includes completed, deleted and hidden tasks, so callers can tell what to
+    remove as well as what to add or update.
+    """
+
+    tasks = get_service('tasks', 'v1').tasks()
+    request = tasks.list(tasklist=LIST_IDS[bucket], updatedMin=updated_min,
+                         showCompleted=True, showDeleted=True,
+                         showHidden=True, maxResults=page_size)
+    yield from iter_pages(tasks, request)
+
+
+def fetch_g_tasks(bucket):
+    """Fetch uncompleted tasks from Google API & return as list of dicts."""
+
+    return list(iter_g_tasks(bucket))
+
+
+def fetch_list_ids():
+    """Return dict of task list IDs keyed by pythonized list name."""
+
     # Initialize Google API service
-    service = build('tasks', 'v1', http=creds.authorize(Http()))
+    service = get_service('tasks', 'v1')
 
     # Call the Tasks API -- get task lists
     lists = {}
-    results = service.tasklists().list().execute()
+    results = execute(service.tasklists().list())
     items = results.get('items', [])
     if not items:
         print('No task lists found.')
@@ -161,61 +368,136 @@ def fetch_g_tasks(bucket):
     # the names. for now I'll maintain it manually
     # with open(LIST_IDS_FILE, 'w') as f:
     #     json.dump(lists, f)
-
-    task_results = service.tasks().list(
-        tasklist=LIST_IDS[bucket], showCompleted=False).execute()
-    tasks = task_results.get('items', [])
-    return tasks
+    return lists
 
 
 def save_g_task(item, list):
     print('HEY!')
     # Setup the Tasks API
-    service = build('tasks', 'v1', http=creds.authorize(Http()))
+    service = get_service('tasks', 'v1')
 
     print(LIST_IDS[list])
-    service.tasks().insert(
-        tasklist=LIST_IDS[list], body=item).execute()
+    execute(service.tasks().insert(tasklist=LIST_IDS[list], body=item))
+
+
+class TaskBatch():
+    """Queue Google Tasks writes and send them as HTTP batch requests.
+
+    Each flush sends at most BATCH_SIZE operations per round trip. Can be used
+    as a context manager, which flushes on exit:
+
+        with TaskBatch() as batch:
+            batch.insert({'title': 'Buy milk'}, 'inbox')
+            batch.delete(taskID, 'inbox')
+
+    """
+
+    def __init__(self, size=BATCH_SIZE):
+        self.service = get_service('tasks', 'v1')
+        self.size = size
+        self.queue = []
+        self.results = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.flush()
+
+    def insert(self, item, list):
+        """Queue new task in list."""
+        request = self.service.tasks().insert(
+            tasklist=LIST_IDS[list], body=item)
+        self.queue.append(('insert', list, item.get('title'), request))
+
+    def delete(self, taskID, list):
+        """Queue deletion of task."""
+        request = self.service.tasks().delete(
+            tasklist=LIST_IDS[list], task=taskID)
+        self.queue.append(('delete', list, taskID, request))
+
+    def complete(self, taskID, list):
+        """Queue marking task as completed."""
+        request = self.service.tasks().patch(
+            tasklist=LIST_IDS[list], task=taskID,
+            body={'status': 'completed'})
+        self.queue.append(('complete', list, taskID, request))
+
+    def move(self, task, from_list, to_list):
+        """Queue moving task (as returned by the API) to another list."""
+        item = {k: task[k] for k in ('title', 'notes', 'due') if k in task}
+        self.insert(item, to_list)
+        self.delete(task['id'], from_list)
+
+    def flush(self):
+        """Send all queued operations. Return list of per-item results.
+
+        Each result is a dict with keys op, list, task (ID, or title for
+        inserts), response and error. error is None if it succeeded.
+
+        Results are added to self.results as each round trip completes. If one
+        fails to send (ie the connection drops), it raises; self.results then
+        has the results of what was sent, and the rest stays queued.
+        """
+        results = []
+        while self.queue:
+            chunk = self.queue[:self.size]
+            batch = self.service.new_batch_http_request()
+            chunk_results = []
+            for op, list, task, request in chunk:
+                result = {'op': op, 'list': list, 'task': task,
+                          'response': None, 'error': None}
+                chunk_results.append(result)
+
+                def callback(request_id, response, exception, result=result):
+                    result['response'] = response
+                    result['error'] = exception
+
+                batch.add(request, callback=callback)
+            with timing.span('batch', 'network', requests=len(chunk)):
+                batch.execute()
+            del self.queue[:len(chunk)]
+            results.extend(chunk_results)
+            self.results.extend(chunk_results)
+        return results
 
 
 def clear_g_list(list):
     """!!!DELETES ALL CONTENTS OF LIST!!!"""
 
-    # Initialize service
-    service = build('tasks', 'v1', http=creds.authorize(Http()))
     # Get list of ids
-    task_results = service.tasks().list(
-        tasklist=LIST_IDS[list], showCompleted=False).execute()
-    tasks = task_results.get('items', [])
+    tasks = fetch_g_tasks(list)
     with open('google_tasks_test.json', 'w') as f:
         json.dump(tasks, f)
-    ids = [x['id'] for x in tasks]
-    for taskID in ids:
-        service.tasks().delete(tasklist=LIST_IDS[list], task=taskID).execute()
+    with TaskBatch() as batch:
+        for task in tasks:
+            batch.delete(task['id'], list)
+    failed = [r for r in batch.results if r['error']]
+    for r in failed:
+        print(f"Failed to delete {r['task']}: {r['error']}")
+    return batch.results
 
 
 def delete_g_task(taskID, list):
     """Delete task from Google tasks."""
 
     # Initialize service
-    service = build('tasks', 'v1', http=creds.authorize(Http()))
+    service = get_service('tasks', 'v1')
     # Delete task
-    service.tasks().delete(tasklist=LIST_IDS[list], task=taskID).execute()
+    execute(service.tasks().delete(tasklist=LIST_IDS[list], task=taskID))
 
 
 def complete_g_task(taskID, list):
     """Mark Google task as completed."""
 
     # Initialize service
-    service = build('tasks', 'v1', http=creds.authorize(Http()))
-
-    # First retrieve the task to update.
-    task = service.tasks().get(
-        tasklist=LIST_IDS[list], task='taskID').execute()
-    task['status'] = 'completed'
+    service = get_service('tasks', 'v1')
 
-    result = service.tasks().update(
-        tasklist=LIST_IDS[list], task=task['id'], body=task).execute()
+    # Patch only the status rather than fetching and re-uploading the task.
+    result = execute(service.tasks().patch(
+        tasklist=LIST_IDS[list], task=taskID,
+        body={'status': 'completed'}))
     # Print the completed date.
     print(f"Task completed at {result['completed']}")
 
@@ -0,0 +1,228 @@
+"""
+Full-text search index over GTD items, shared by pygtd and oopygtd.
+
+Titles and notes are split into lowercase words and kept in search.db as an
+inverted index: a postings table listing, for each word, the items it appears
+in. Items are added and removed one at a time as they change, so the index
+never needs rebuilding. Each query word matches every indexed word it's a
+prefix of, found with a range scan on the postings primary key, and results
+are ranked by tf-idf.
+
+Items are identified by (source, container, key), where source is the app that
+owns them ('pygtd' or 'google'). Data stored before there was an index is added
+by build(), which each source needs to run once (see built()). A source that
+indexes its changes in batches, rather than as they're made, can keep track of
+how far it got with position().
+"""
+
+import math
+import re
+import sqlite3
+import timing
+from collections import Counter
+from heapq import nlargest
+from inspect import currentframe, getframeinfo
+from pathlib import Path
+from time import time
+
+FILENAME = getframeinfo(currentframe()).filename
+PARENT = Path(FILENAME).resolve().parent
+SEARCH_FILE = PARENT / 'search.db'
+
+# Max number of results returned by query().
+LIMIT = 20
+
+WORD = re.compile(r'\w+')
+
+# Sorts after any character in a word, so [prefix, prefix + MAX_CHAR) is the
+# range of words starting with prefix.
+MAX_CHAR = '\U0010ffff'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS docs (
+    id INTEGER PRIMARY KEY,
+    source TEXT NOT NULL,
+    container TEXT NOT NULL,
+    key TEXT NOT NULL,
+    text TEXT NOT NULL,
+    length INTEGER NOT NULL,
+    UNIQUE (source, container, key)
+);
+CREATE TABLE IF NOT EXISTS postings (
+    term TEXT NOT NULL,
+    doc INTEGER NOT NULL,
+    tf INTEGER NOT NULL,
+    PRIMARY KEY (term, doc)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS built (
+    source TEXT PRIMARY KEY,
+    time REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS positions (
+    source TEXT PRIMARY KEY,
+    position INTEGER NOT NULL
+);
+'''
+
+
+def connect():
+    """Open index in WAL mode, creating tables if needed.
+
+    The connection may be shared between threads as long as they take turns.
+    """
+    conn = sqlite3.connect(str(SEARCH_FILE), timeout=30,
+                           check_same_thread=False)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def words(text):
+    """Return list of lowercase words in text."""
+    return WORD.findall(text.lower())
+
+
+def document(value):
+    """Return searchable text of item.
+
+    Items are plain strings or dicts (pygtd items, Google tasks), of which
+    the title, text, short name and notes are indexed.
+    """
+    if isinstance(value, str):
+        return value
+    fields = (value.get(name) for name in ('title', 'short_name', 'text',
+                                           'notes'))
+    return ' '.join(field for field in fields if isinstance(field, str))
+
+
+def count(conn, source):
+    """Return number of items indexed for source."""
+    return conn.execute('SELECT COUNT(*) FROM docs WHERE source = ?',
+                        (source,)).fetchone()[0]
+
+
+def built(conn, source):
+    """Return True if build() has indexed everything stored for source.
+
+    Items added since are indexed as they change, but only build() covers
+    items stored before there was an index, so it's needed even if some items
+    are already indexed.
+    """
+    return conn.execute('SELECT 1 FROM built WHERE source = ?',
+                        (source,)).fetchone() is not None
+
+
+def position(conn, source):
+    """Return how far source's changes have been indexed, or 0.
+
+    What the number means is up to the source, ie an offset in its log of
+    changes.
+    """
+    row = conn.execute('SELECT position FROM positions WHERE source = ?',
+                       (source,)).fetchone()
+    return row[0] if row else 0
+
+
+def set_position(conn, source, position):
+    """Record how far source's changes have been indexed."""
+    conn.execute('INSERT OR REPLACE INTO positions VALUES (?, ?)',
+                 (source, position))
+
+
+def rename(conn, source, container, key, new_key):
+    """Change key of indexed item, ie once it has an ID from the server."""
+    remove(conn, source, container, new_key)
+    conn.execute('UPDATE docs SET key = ? WHERE source = ? AND container = ? '
+                 'AND key = ?', (str(new_key), source, container, str(key)))
+
+
+def forget(conn, doc, text):
+    """Delete postings and row of document."""
+    conn.executemany('DELETE FROM postings WHERE term = ? AND doc = ?',
+                     [(term, doc) for term in set(words(text))])
+    conn.execute('DELETE FROM docs WHERE id = ?', (doc,))
+
+
+def remove(conn, source, container, key):
+    """Remove item from index, if it's there."""
+    row = conn.execute(
+        'SELECT id, text FROM docs WHERE source = ? AND container = ? '
+        'AND key = ?', (source, container, str(key))).fetchone()
+    if row:
+        forget(conn, *row)
+
+
+def add(conn, source, container, key, value):
+    """Index item, replacing what was indexed for it before."""
+    remove(conn, source, container, key)
+    text = document(value)
+    counts = Counter(words(text))
+    if not counts:
+        return
+    doc = conn.execute(
+        'INSERT INTO docs (source, container, key, text, length) '
+        'VALUES (?, ?, ?, ?, ?)',
+        (source, container, str(key), text, sum(counts.values()))).lastrowid
+    conn.executemany('INSERT INTO postings VALUES (?, ?, ?)',
+                     [(term, doc, tf) for term, tf in counts.items()])
+
+
+def clear(conn, source, container=None):
+    """Remove all items in container (or all containers) from index."""
+    if container is None:
+        rows = conn.execute('SELECT id, text FROM docs WHERE source = ?',
+                            (source,)).fetchall()
+    else:
+        rows = conn.execute(
+            'SELECT id, text FROM docs WHERE source = ? AND container = ?',
+            (source, container)).fetchall()
+    for doc, text in rows:
+        forget(conn, doc, text)
+
+
+def build(conn, source, items):
+    """Index (container, key, value) triples for source from scratch.
+
+    items must be everything stored for source. Only needed once, for data
+    stored before there was an index; built() tells whether it's been done.
+    """
+    with conn:
+        clear(conn, source)
+        for container, key, value in items:
+            add(conn, source, container, key, value)
+        conn.execute('INSERT OR REPLACE INTO built VALUES (?, ?)',
+                     (source, time()))
+
+
+@timing.span('search.query', 'storage')
+def query(conn, source, text, limit=LIMIT):
+    """Return up to limit best matches for text as (container, key, text).
+
+    Items must match every word of text, each as a prefix. Matches are
+    ranked by the sum over matched words of tf (relative to item length)
+    times idf.
+    """
+    terms = set(words(text))
+    total = count(conn, source)
+    scores = None
+    for prefix in terms:
+        matches = conn.execute(
+            'SELECT term, doc, tf, length FROM postings '
+            'JOIN docs ON docs.id = postings.doc '
+            'WHERE term >= ? AND term < ? AND source = ?',
+            (prefix, prefix + MAX_CHAR, source)).fetchall()
+        df = Counter(term for term, _, _, _ in matches)
+        found = Counter()
+        for term, doc, tf, length in matches:
+            found[doc] += tf / length * math.log(1 + total / df[term])
+        if scores is not None:
+            found = {doc: score + scores[doc]
+                     for doc, score in found.items() if doc in scores}
+        scores = found
+        if not scores:
+            return []
+    if scores is None:
+        return []
+    best = nlargest(limit, scores, key=scores.get)
+    return [conn.execute('SELECT container, key, text FROM docs WHERE id = ?',
+                         (doc,)).fetchone() for doc in best]
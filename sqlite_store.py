@@ -0,0 +1,172 @@
+"""
+SQLite storage backend for pygtd data.
+
+All containers share one items table keyed by (container, key). Each value is
+stored as JSON text. Writes touch a single row, and reading a container is a
+range scan over the (container, created) index, so a command only pays for the
+containers it actually uses.
+
+Every write also logs which items it changed in the changes table, in the same
+transaction, so the search index can catch up with them later (see changes()).
+"""
+
+import json
+import sqlite3
+from time import time
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS items (
+    container TEXT NOT NULL,
+    key TEXT NOT NULL,
+    created REAL NOT NULL,
+    value TEXT NOT NULL,
+    PRIMARY KEY (container, key)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS items_created ON items (container, created);
+CREATE TABLE IF NOT EXISTS changes (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    container TEXT NOT NULL,
+    key TEXT
+);
+'''
+
+
+def connect(path):
+    """Open database at path in WAL mode, creating tables if needed.
+
+    The connection may be shared between threads (ie by gtdd.py's request
+    handlers) as long as they take turns.
+    """
+    conn = sqlite3.connect(str(path), check_same_thread=False)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def created(key):
+    """Return creation time for key.
+
+    Keys are normally Unix timestamps, so use them when possible.
+    """
+    try:
+        return float(key)
+    except ValueError:
+        return time()
+
+
+def count(conn, container=None):
+    """Return number of items in container, or in all containers."""
+    if container is None:
+        row = conn.execute('SELECT COUNT(*) FROM items').fetchone()
+    else:
+        row = conn.execute('SELECT COUNT(*) FROM items WHERE container = ?',
+                           (container,)).fetchone()
+    return row[0]
+
+
+def containers(conn):
+    """Return set of names of containers that have items."""
+    return {name for name, in conn.execute('SELECT DISTINCT container '
+                                           'FROM items')}
+
+
+def items(conn, container):
+    """Yield (key, value) pairs for container, oldest first."""
+    rows = conn.execute(
+        'SELECT key, value FROM items WHERE container = ? ORDER BY created',
+        (container,))
+    for key, value in rows:
+        yield key, json.loads(value)
+
+
+def get(conn, container, key):
+    """Return value of item, or None if there's no such item."""
+    row = conn.execute('SELECT value FROM items WHERE container = ? '
+                       'AND key = ?', (container, key)).fetchone()
+    return json.loads(row[0]) if row else None
+
+
+def log(conn, container, key=None):
+    """Record that item (or with no key, all of container) changed."""
+    conn.execute('INSERT INTO changes (container, key) VALUES (?, ?)',
+                 (container, key))
+
+
+def last_change(conn):
+    """Return sequence number of the latest change logged, or 0."""
+    row = conn.execute("SELECT seq FROM sqlite_sequence "
+                       "WHERE name = 'changes'").fetchone()
+    return row[0] if row else 0
+
+
+def changes(conn, start, end):
+    """Return (container, key) of changes logged after start up to end.
+
+    key is None if the whole container changed.
+    """
+    return conn.execute('SELECT container, key FROM changes '
+                        'WHERE seq > ? AND seq <= ? ORDER BY seq',
+                        (start, end)).fetchall()
+
+
+def forget_changes(conn, end):
+    """Delete logged changes up to end, once they've been dealt with."""
+    with conn:
+        conn.execute('DELETE FROM changes WHERE seq <= ?', (end,))
+
+
+def put(conn, container, key, value):
+    """Insert or replace a single item."""
+    with conn:
+        conn.execute(
+            'INSERT OR REPLACE INTO items (container, key, created, value) '
+            'VALUES (?, ?, ?, ?)',
+            (container, key, created(key), json.dumps(value)))
+        log(conn, container, key)
+
+
+def put_many(conn, container, pairs):
+    """Insert (key, value) pairs from an iterable. Return number inserted.
+
+    Everything is committed in a single transaction at the end, so if pairs
+    raises, nothing is.
+    """
+    n = 0
+    sql = ('INSERT OR REPLACE INTO items (container, key, created, value) '
+           'VALUES (?, ?, ?, ?)')
+    with conn:
+        for key, value in pairs:
+            conn.execute(sql, (container, key, created(key),
+                               json.dumps(value)))
+            log(conn, container, key)
+            n += 1
+    return n
+
+
+def delete(conn, container, key):
+    """Delete a single item."""
+    with conn:
+        conn.execute('DELETE FROM items WHERE container = ? AND key = ?',
+                     (container, key))
+        log(conn, container, key)
+
+
+def clear(conn, container):
+    """Delete all items in container."""
+    with conn:
+        conn.execute('DELETE FROM items WHERE container = ?', (container,))
+        log(conn, container)
+
+
+def save(conn, data):
+    """Replace stored contents of every container in data dict."""
+    with conn:
+        for container, contents in data.items():
+            conn.execute('DELETE FROM items WHERE container = ?',
+                         (container,))
+            log(conn, container)
+            conn.executemany(
+                'INSERT INTO items (container, key, created, value) '
+                'VALUES (?, ?, ?, ?)',
+                ((container, key, created(key), json.dumps(value))
+                 for key, value in contents.items()))
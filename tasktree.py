@@ -0,0 +1,99 @@
+"""
+Tree index for Google Tasks subtasks.
+
+Google returns tasks with a parent ID and a position string that orders
+siblings, but not necessarily with parents ahead of their children (ie with
+pagination or concurrent fetches). TaskTree indexes tasks in any order and
+keeps each task's children sorted by position.
+"""
+
+from bisect import bisect
+
+
+def sort_key(item):
+    """Return key that orders sibling tasks as Google does."""
+    return item.position or ''
+
+
+class TaskTree():
+    """Index of Task objects (see model.py) by ID and by parent.
+
+    Tasks whose parent isn't in the tree are treated as top-level tasks.
+
+    """
+
+    def __init__(self, items=()):
+        """Index items in one pass."""
+        self.items = {item.id: item for item in items}
+        self.children = {None: []}
+        self.depths = {}
+        for id, item in self.items.items():
+            self.children.setdefault(self.parent(id), []).append(id)
+        for ids in self.children.values():
+            ids.sort(key=lambda id: sort_key(self.items[id]))
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, id):
+        return id in self.items
+
+    def parent(self, id):
+        """Return ID of task's parent, or None if it's top-level."""
+        parent = self.items[id].parent
+        return parent if parent in self.items else None
+
+    def depth(self, id):
+        """Return how deeply task is nested (0 for top-level tasks)."""
+        chain = []
+        while id is not None and id not in self.depths:
+            chain.append(id)
+            id = self.parent(id)
+        depth = -1 if id is None else self.depths[id]
+        for id in reversed(chain):
+            depth += 1
+            self.depths[id] = depth
+        return depth
+
+    def walk(self, root=None):
+        """Yield (depth, task) for tasks in display order.
+
+        If root is given, only its subtree is walked, root included.
+        """
+        if root is None:
+            stack = [(0, id) for id in reversed(self.children[None])]
+        else:
+            stack = [(self.depth(root), root)]
+        while stack:
+            depth, id = stack.pop()
+            yield depth, self.items[id]
+            for child in reversed(self.children.get(id, ())):
+                stack.append((depth + 1, child))
+
+    def subtree(self, id):
+        """Yield task and all its descendants in display order."""
+        for _, item in self.walk(id):
+            yield item
+
+    def move(self, id, parent=None, position=None):
+        """Move task under new parent (None for top level) at position."""
+        self.children[self.parent(id)].remove(id)
+        item = self.items[id]
+        item.parent = parent
+        if position is not None:
+            item.position = position
+        siblings = self.children.setdefault(self.parent(id), [])
+        keys = [sort_key(self.items[sibling]) for sibling in siblings]
+        siblings.insert(bisect(keys, sort_key(item)), id)
+        for moved in self.subtree(id):
+            self.depths.pop(moved.id, None)
+
+    def delete(self, id):
+        """Remove task and all its descendants. Return removed tasks."""
+        removed = list(self.subtree(id))
+        self.children[self.parent(id)].remove(id)
+        for item in removed:
+            del self.items[item.id]
+            self.children.pop(item.id, None)
+            self.depths.pop(item.id, None)
+        return removed
@@ -0,0 +1,84 @@
+"""Tests for opqueue: queued changes survive a failed send."""
+
+import mirror
+import opqueue
+import search
+import sys
+import tempfile
+import types
+import unittest
+from pathlib import Path
+from unittest import mock
+
+
+class FakeBatch():
+    """Stand-in for quickstart.TaskBatch that records what it sends."""
+
+    sent = []
+    fail = False
+
+    def __init__(self):
+        self.queue = []
+        self.results = []
+
+    def insert(self, item, list):
+        self.queue.append(('insert', list, dict(item)))
+
+    def delete(self, taskID, list):
+        self.queue.append(('delete', list, taskID))
+
+    def complete(self, taskID, list):
+        self.queue.append(('complete', list, taskID))
+
+    def flush(self):
+        if FakeBatch.fail:
+            raise ConnectionError('offline')
+        for n, op in enumerate(self.queue):
+            FakeBatch.sent.append(op)
+            self.results.append({'error': None,
+                                 'response': {'id': 'remote-%d' % n}})
+        self.queue = []
+
+
+class DrainTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = Path(tempfile.mkdtemp(prefix='test_opqueue.'))
+        quickstart = types.ModuleType('quickstart')
+        quickstart.TaskBatch = FakeBatch
+        for patch in [
+                mock.patch.object(opqueue, 'QUEUE_FILE',
+                                  directory / 'opqueue.db'),
+                mock.patch.object(opqueue, 'LOCK_FILE',
+                                  directory / 'opqueue.lock'),
+                mock.patch.object(mirror, 'MIRROR_FILE',
+                                  directory / 'mirror.db'),
+                mock.patch.object(search, 'SEARCH_FILE',
+                                  directory / 'search.db'),
+                # Drain only when the test says so.
+                mock.patch.object(opqueue, 'start', lambda: None),
+                mock.patch.dict(sys.modules, quickstart=quickstart)]:
+            patch.start()
+            self.addCleanup(patch.stop)
+        FakeBatch.sent = []
+        FakeBatch.fail = False
+
+    def test_completed_insert_survives_failed_flush(self):
+        task = opqueue.submit('insert', 'inbox', body={'title': 'Buy milk'})
+        opqueue.submit('complete', 'inbox', task=task)
+
+        FakeBatch.fail = True
+        with self.assertRaises(ConnectionError):
+            opqueue.drain()
+        self.assertEqual(FakeBatch.sent, [])
+        self.assertEqual(opqueue.count(), 1)
+
+        FakeBatch.fail = False
+        opqueue.drain()
+        self.assertEqual(FakeBatch.sent, [
+            ('insert', 'inbox', {'title': 'Buy milk', 'status': 'completed'})])
+        self.assertEqual(opqueue.count(), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
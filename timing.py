@@ -0,0 +1,133 @@
+"""
+Lightweight timing spans, for seeing where a run spends its time.
+
+A span times a block of code or, used as a decorator, each call of a function:
+
+    with timing.span('fetch tasks', 'network', bucket=bucket):
+        ...
+
+    @timing.span('render overview', 'render')
+    def print_overview(self):
+        ...
+
+Spans only cost a flag check unless profiling is on, which it is if
+PYGTD_PROFILE is set (or after enable() is called, ie by --profile). Then
+every finished span is recorded, and dump() writes them to a Chrome trace
+event file (load it in chrome://tracing or https://ui.perfetto.dev) and prints
+a summary of time spent per span name.
+"""
+
+import functools
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from inspect import currentframe, getframeinfo
+from pathlib import Path
+
+FILENAME = getframeinfo(currentframe()).filename
+PARENT = Path(FILENAME).resolve().parent
+TRACE_FILE = PARENT / 'pygtd-trace.json'
+
+enabled = bool(os.environ.get('PYGTD_PROFILE'))
+started = time.perf_counter()
+records = []  # (name, category, args, thread, start, duration)
+lock = threading.Lock()
+
+
+def enable():
+    """Start recording spans."""
+    global enabled
+    enabled = True
+
+
+class span():
+    """Context manager and decorator that records how long code takes.
+
+    category groups spans in the trace viewer, ie 'network', 'storage' or
+    'render'. Keyword arguments are shown with the span.
+    """
+
+    def __init__(self, name, category='app', **args):
+        self.name = name
+        self.category = category
+        self.args = args
+        self.start = None
+
+    def __enter__(self):
+        if enabled:
+            self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.start is not None:
+            duration = time.perf_counter() - self.start
+            with lock:
+                records.append((self.name, self.category, self.args,
+                                threading.current_thread(), self.start,
+                                duration))
+            self.start = None
+
+    def __call__(self, func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            # New span per call, so calls from several threads don't mix.
+            with span(self.name, self.category, **self.args):
+                return func(*args, **kwargs)
+        return wrapper
+
+
+def trace_events():
+    """Return recorded spans as Chrome trace events."""
+    pid = os.getpid()
+    events = []
+    threads = {}
+    for name, category, args, thread, start, duration in records:
+        threads[thread.ident] = thread.name
+        events.append({
+            'name': name,
+            'cat': category,
+            'ph': 'X',
+            'ts': (start - started) * 1e6,
+            'dur': duration * 1e6,
+            'pid': pid,
+            'tid': thread.ident,
+            'args': {k: str(v) for k, v in args.items()},
+        })
+    for ident, thread_name in threads.items():
+        events.append({'name': 'thread_name', 'ph': 'M', 'pid': pid,
+                       'tid': ident, 'args': {'name': thread_name}})
+    return events
+
+
+def summary():
+    """Return summary table of recorded spans, slowest total first."""
+    totals = defaultdict(list)
+    for name, category, _, _, _, duration in records:
+        totals[(name, category)].append(duration)
+    wall = time.perf_counter() - started
+    lines = ['{:32} {:8} {:>6} {:>9} {:>9} {:>9} {:>6}'.format(
+        'span', 'category', 'calls', 'total ms', 'mean ms', 'max ms', '%')]
+    for (name, category), durations in sorted(
+            totals.items(), key=lambda item: -sum(item[1])):
+        total = sum(durations)
+        lines.append('{:32} {:8} {:>6} {:>9.1f} {:>9.1f} {:>9.1f} {:>6.1f}'
+                     .format(name[:32], category, len(durations),
+                             total * 1000, total / len(durations) * 1000,
+                             max(durations) * 1000, total / wall * 100))
+    lines.append('Wall time {:.1f} ms. Spans in different threads overlap, '
+                 'so % can add up to more than 100.'.format(wall * 1000))
+    return '\n'.join(lines)
+
+
+def dump(path=TRACE_FILE):
+    """Write trace file and print summary, if profiling is on."""
+    if not enabled:
+        return
+    with lock:
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': trace_events(),
+                       'displayTimeUnit': 'ms'}, f)
+        print(summary())
+    print(f'Trace written to {path}')